@@ -0,0 +1,98 @@
+import logging
+import random
+import sys
+import time
+
+from main import WireFormat, DECK_SIZE, SUITS, get_trick_winner
+from server import Server, Game
+from test_cards import get_trick_winner_by_sorting
+
+
+class BenchmarkSocket:
+    def __init__(self) -> None:
+        self.bytes_sent: int = 0
+
+    def getblocking(self) -> bool:
+        # Counted synchronously, so the connection writes straight through instead of using its writer thread.
+        return False
+
+    def sendall(self, data: bytes) -> None:
+        self.bytes_sent += len(data)
+
+    def shutdown(self, how: int) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def create_table(
+        server: Server, number_of_players: int, token_prefix: str = "benchmark",
+        wire_format: WireFormat = WireFormat.JSON) -> tuple[Game, dict[str, str]]:
+    # Connect players through the normal connection path and seat them at one table.
+    tokens: dict[str, str] = {}
+    for i in range(number_of_players):
+        client = server.connect_client(BenchmarkSocket(), ("127.0.0.1", i), f"{token_prefix}-{i}", wire_format)
+        tokens[client.uuid] = client.hashed_token
+    host_token = next(iter(tokens.values()))
+    code = server.controller.request_new_game(host_token)[1]["code"]
+    for token in list(tokens.values())[1:]:
+        server.controller.request_game_join(token, code)
+    return server.game_manager.lobbies[code], tokens
+
+
+def fill_history(game: Game, number_of_rounds: int) -> None:
+    # Give every player a full history of finished rounds and a hand for the current one.
+    game.started = True
+    game.number_of_rounds = number_of_rounds
+    game.round_number = number_of_rounds - 1
+    game.tricks_available = 1
+    game.set_up_seats()
+    game.current_player_order = game.get_player_order(game.initial_player_order[0])
+    for round_number in range(number_of_rounds):
+        deck = random.sample(range(DECK_SIZE), len(game.players) * 7)
+        for i, player in enumerate(game.players):
+            game.players[player]["rounds"][round_number] = {
+                "prediction": 1, "cards_left": 0, "tricks_won": 1, "score": 11}
+            hand = sum(1 << card for card in deck[i * 7:(i + 1) * 7])
+            game.private_data[player][round_number] = {"initial_hand": hand, "hand": hand}
+
+
+def benchmark_game_update(number_of_players: int, number_of_rounds: int, updates: int = 2000) -> None:
+    server = Server(database_path=":memory:")
+    game, tokens = create_table(server, number_of_players)
+    fill_history(game, number_of_rounds)
+    game.send_update()
+    sockets = [server.clients[token].socket for token in tokens.values()]
+    bytes_before = sum(s.bytes_sent for s in sockets)
+
+    # Each update changes one player's current round, like placing a card does.
+    players = list(game.players)
+    start = time.perf_counter()
+    for i in range(updates):
+        game.players[players[i % len(players)]]["rounds"][game.round_number]["cards_left"] ^= 1
+        game.send_update()
+    elapsed = time.perf_counter() - start
+
+    bytes_per_update = (sum(s.bytes_sent for s in sockets) - bytes_before) / updates
+    print(f"{number_of_players} players, {number_of_rounds} rounds: "
+          f"{elapsed / updates * 1e6:.1f} us per update, {bytes_per_update:.0f} bytes per update")
+
+
+def benchmark_trick_winner(trick_size: int, evaluations: int = 100000) -> None:
+    tricks = [(random.sample(range(DECK_SIZE), trick_size), random.randint(-1, len(SUITS) - 1)) for _ in range(1000)]
+    for evaluate in (get_trick_winner, get_trick_winner_by_sorting):
+        start = time.perf_counter()
+        for i in range(evaluations):
+            evaluate(*tricks[i % len(tricks)])
+        elapsed = time.perf_counter() - start
+        print(f"{evaluate.__name__}, {trick_size} cards: {elapsed / evaluations * 1e9:.0f} ns per trick")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    random.seed(0)
+    for players, rounds in ((2, 17), (4, 17), (7, 7), (7, 17)):
+        benchmark_game_update(players, rounds, int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    for trick_size in (2, 4, 7):
+        benchmark_trick_winner(trick_size)
@@ -1,5 +1,4 @@
 import copy
-import json
 import logging
 import os
 import socket
@@ -13,8 +12,8 @@ from pprint import pprint
 import customtkinter as ctk
 from PIL import Image
 
-from main import ConnectionToServer, recvall, HEADER_SIZE, SERVER_PORT, SERVER_IP, DataPacketState, ResponseState, \
-    RequestState, GameWaitingState
+from main import ConnectionToServer, SERVER_PORT, SERVER_IP, DataPacketState, ResponseState, RequestState, \
+    GameWaitingState, WIRE_FORMAT, create_handshake, read_message, apply_patch
 
 ctk.set_default_color_theme(r"resources/ui_theme.json")
 
@@ -46,10 +45,10 @@ class Client:
         except ConnectionRefusedError as e:
             logging.warning("Could not connect to server " + str(e))
             sys.exit()
-        self.connection: ConnectionToServer = ConnectionToServer(server_socket, f"{SERVER_IP}:{SERVER_PORT}")
+        self.connection: ConnectionToServer = ConnectionToServer(
+            server_socket, f"{SERVER_IP}:{SERVER_PORT}", WIRE_FORMAT)
         logging.info("Established connection to server.")
-        encoded_token = self.connection_token.encode()
-        self.connection.socket.sendall(f"{len(encoded_token):<8}".encode() + encoded_token)
+        self.connection.socket.sendall(create_handshake(self.connection_token, WIRE_FORMAT))
 
         threading.Thread(target=self.controller.ui_connection_established).start()
 
@@ -59,16 +58,16 @@ class Client:
     def server_thread(self):
         while True:
             try:
-                header: bytes = recvall(self.connection.socket, HEADER_SIZE)
-                if not len(header):
+                packet: dict | None = read_message(self.connection.socket, self.connection.wire_format)
+                if packet is None:
                     break
-                packet: dict = json.loads(recvall(self.connection.socket, int(header.decode())))
-                threading.Thread(target=lambda: self.handle_packet(packet)).start()
+                # Packets are handled in order so game patches apply to the version they were made from.
+                self.handle_packet(packet)
             except Exception as e:
                 logging.error(f"Unexpected Error: {e}")
                 break
         logging.warning("Lost connection to server.")
-        self.connection.socket.close()
+        self.connection.close()
 
     def handle_packet(self, packet: dict) -> None:
 
@@ -78,7 +77,7 @@ class Client:
                 case _:
                     logging.warning("Received invalid request.")
                     result = ResponseState.INVALID_REQUEST, ""
-            self.connection.respond(result[0], result[1])
+            self.connection.respond(result[0], result[1], packet.get("id"))
             logging.info(f"Responded to server with {result[0]}.")
 
         # Handle response.
@@ -101,11 +100,13 @@ class Client:
                     logging.info("Game started successfully.")
                 case ResponseState.START_GAME_FAILED.value:
                     logging.warning(f"Failed to start game: {packet["data"]}.")
+                case ResponseState.GAME_DATA.value:
+                    self.controller.process_game_data(packet["data"])
                 case ResponseState.INVALID_REQUEST.value:
                     logging.warning("Request sent was invalid.")
                 case _:
                     logging.warning(f"Received invalid response ({packet}).")
-            self.connection.has_responded = True
+            self.connection.response_received(packet.get("id"))
 
         # Handle data packet.
         elif packet["state"].startswith("DP"):
@@ -113,10 +114,17 @@ class Client:
                 case DataPacketState.GAME_DATA.value:
                     self.controller.process_game_data(packet["data"])
 
+                case DataPacketState.GAME_PATCH.value:
+                    self.controller.process_game_patch(packet["data"])
+
                 case DataPacketState.UUID.value:
                     self.uuid: str = packet["data"]
                     logging.info(f"Received UUID ({self.uuid}).")
 
+                case DataPacketState.HEARTBEAT.value:
+                    # The server asks after a quiet spell, answering keeps the connection and the seat.
+                    self.connection.send_packet(DataPacketState.HEARTBEAT, "")
+
                 case _:
                     logging.warning("Received invalid data packet.")
 
@@ -223,6 +231,16 @@ class Controller:
         if len(data["players"]) > 2:
             self.gui.lobby_page.start_button.configure(state="normal")
 
+    def process_game_patch(self, data):
+        game_data = self.cached_data["game_data"]
+        # A patch only applies to the version it was made from, otherwise ask for a full snapshot.
+        if game_data.get("version") != data["base"]:
+            logging.warning(f"Game data is at version {game_data.get("version")} but patch is for {data["base"]}.")
+            self.client.connection.request(RequestState.GAME_DATA, "")
+            return
+        apply_patch(game_data, data["ops"])
+        self.process_game_data(game_data)
+
     def ui_display_lobby_players(self):
         i = -1
         for i, player in enumerate(self.cached_data["game_data"]["initial_player_order"]):
@@ -303,8 +321,8 @@ class Controller:
 
         i = -1
         hand = sorted(
-            self.cached_data["game_data"]["players"][self.client.uuid]["rounds"][
-                f"{self.cached_data["game_data"]["round_number"]}"]["hand"], key=sort_key)
+            self.cached_data["game_data"]["private"][f"{self.cached_data["game_data"]["round_number"]}"]["hand"],
+            key=sort_key)
         for i, card in enumerate(hand):
             self.gui.game_page.player_cards[i].configure(
                 image=ctk.CTkImage(Image.open(
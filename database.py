@@ -0,0 +1,183 @@
+import itertools
+import logging
+import sqlite3
+import threading
+import typing
+
+SCHEMA: list[str] = [
+    """CREATE TABLE IF NOT EXISTS Users (id INTEGER PRIMARY KEY, uuid TEXT, username TEXT, connection_hash TEXT,
+    guest INTEGER, password_salt TEXT, password_hash TEXT, game_code TEXT);""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_uuid ON Users (uuid);",
+    "CREATE INDEX IF NOT EXISTS users_connection_hash ON Users (connection_hash);",
+    # Case-folded names in use and who holds them, one each, servers sharing the database all claim names here.
+    "CREATE TABLE IF NOT EXISTS Usernames (username TEXT PRIMARY KEY, uuid TEXT, guest INTEGER);",
+    "CREATE UNIQUE INDEX IF NOT EXISTS usernames_uuid ON Usernames (uuid);",
+]
+
+SELECT_USERNAMES_TABLE = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Usernames';"
+CLAIM_REGISTERED_USERNAMES = """INSERT OR IGNORE INTO Usernames (username, uuid, guest)
+    SELECT casefold(username), uuid, 0 FROM Users WHERE guest = 0 AND username != '';"""
+
+SELECT_USER = "SELECT connection_hash, game_code, username, guest FROM Users WHERE uuid = ?;"
+INSERT_USERNAME = "INSERT INTO Usernames (username, uuid, guest) VALUES (?, ?, ?);"
+DELETE_USERNAME = "DELETE FROM Usernames WHERE uuid = ?;"
+DELETE_GUEST_USERNAMES = "DELETE FROM Usernames WHERE guest = 1;"
+CLEAR_GUEST_USERNAMES = "UPDATE Users SET username = '' WHERE guest = 1 AND username != '';"
+
+# Columns the journal may write, statements are only ever built from these names.
+USER_COLUMNS: tuple[str, ...] = ("username", "connection_hash", "guest", "password_salt", "password_hash", "game_code")
+
+FLUSH_INTERVAL = 1.0
+
+memory_database_ids: typing.Iterator[int] = itertools.count()
+
+
+class Database:
+    def __init__(self, path: str = "BlobDB.db", flush_interval: float = FLUSH_INTERVAL) -> None:
+        # In-memory databases are shared between the per-thread connections through a named shared cache.
+        if path == ":memory:":
+            self.path: str = f"file:blob-{next(memory_database_ids)}?mode=memory&cache=shared"
+        else:
+            self.path: str = path
+        self.flush_interval: float = flush_interval
+        self.local: threading.local = threading.local()
+
+        # Every write goes through one writer connection so writes never contend for the database lock.
+        self.writer_connection: sqlite3.Connection = self.connect()
+        # Held while the writer connection is in a transaction, names are claimed on it between flushes.
+        self.writer_lock: threading.Lock = threading.Lock()
+        # Names registered before the Usernames table existed are claimed once, when it is created.
+        claim_registered = self.writer_connection.execute(SELECT_USERNAMES_TABLE).fetchone() is None
+        for statement in SCHEMA:
+            self.writer_connection.execute(statement)
+        if claim_registered:
+            self.writer_connection.execute(CLAIM_REGISTERED_USERNAMES)
+        self.writer_connection.commit()
+
+        # Pending changes per user, later changes to the same column replace earlier ones until the next flush.
+        self.journal: dict[str, dict[str, dict]] = {}
+        self.journal_condition: threading.Condition = threading.Condition()
+        self.flushes_requested: int = 0
+        self.flushes_completed: int = 0
+        self.closing: bool = False
+
+        self.writer_thread: threading.Thread = threading.Thread(target=self.loop_writes, daemon=True)
+        self.writer_thread.start()
+        logging.info(f"Connected to database {path}.")
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, uri=self.path.startswith("file:"), check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = NORMAL;")
+        connection.create_function("casefold", 1, str.casefold, deterministic=True)
+        return connection
+
+    def get_connection(self) -> sqlite3.Connection:
+        # Reads use a connection owned by the calling thread, so cursors are never shared.
+        if not hasattr(self.local, "connection"):
+            self.local.connection = self.connect()
+        return self.local.connection
+
+    def fetchone(self, statement: str, parameters: tuple = ()) -> tuple | None:
+        return self.get_connection().execute(statement, parameters).fetchone()
+
+    def write_user(self, user_uuid: str, *, insert: dict | None = None, **columns: typing.Any) -> None:
+        with self.journal_condition:
+            entry = self.journal.setdefault(user_uuid, {"insert": {}, "update": {}})
+            if insert:
+                entry["insert"] |= insert
+            entry["update"] |= columns
+
+    def loop_writes(self) -> None:
+        while True:
+            with self.journal_condition:
+                self.journal_condition.wait_for(
+                    lambda: self.closing or self.flushes_requested > self.flushes_completed, self.flush_interval)
+                journal, self.journal = self.journal, {}
+                flushes_requested = self.flushes_requested
+                closing = self.closing
+            if journal:
+                self.write(journal)
+            with self.journal_condition:
+                self.flushes_completed = flushes_requested
+                self.journal_condition.notify_all()
+            if closing:
+                return
+
+    def write(self, journal: dict[str, dict[str, dict]]) -> None:
+        # Everything collected since the last flush is written in one transaction.
+        failed = 0
+        try:
+            with self.writer_lock, self.writer_connection:
+                self.writer_connection.execute("BEGIN;")
+                for statement in self.get_user_statements(journal):
+                    # Each statement has its own savepoint, so one that fails does not undo the rest of the batch.
+                    self.writer_connection.execute("SAVEPOINT statement;")
+                    try:
+                        self.writer_connection.execute(*statement)
+                    except sqlite3.Error as e:
+                        logging.error(f"Database error while flushing {statement[0]!r}: {e}")
+                        self.writer_connection.execute("ROLLBACK TO statement;")
+                        failed += 1
+                    self.writer_connection.execute("RELEASE statement;")
+            logging.info(f"Flushed {len(journal)} users to the database, {failed} statements failed.")
+        except sqlite3.Error as e:
+            logging.error(f"Database error while flushing: {e}")
+
+    @staticmethod
+    def get_user_statements(journal: dict[str, dict[str, dict]]) -> typing.Iterator[tuple[str, tuple]]:
+        for user_uuid, entry in journal.items():
+            if entry["insert"]:
+                columns = [column for column in USER_COLUMNS if column in entry["insert"]]
+                yield (f"INSERT OR IGNORE INTO Users (uuid, {", ".join(columns)}) VALUES (?{", ?" * len(columns)});",
+                       (user_uuid, *(entry["insert"][column] for column in columns)))
+            if entry["update"]:
+                columns = [column for column in USER_COLUMNS if column in entry["update"]]
+                yield (f"UPDATE Users SET {", ".join(f"{column} = ?" for column in columns)} WHERE uuid = ?;",
+                       (*(entry["update"][column] for column in columns), user_uuid))
+
+    def flush(self) -> None:
+        with self.journal_condition:
+            self.flushes_requested += 1
+            flush = self.flushes_requested
+            self.journal_condition.notify_all()
+            self.journal_condition.wait_for(lambda: self.flushes_completed >= flush)
+
+    def close(self) -> None:
+        with self.journal_condition:
+            self.closing = True
+            self.journal_condition.notify_all()
+        self.writer_thread.join()
+        with self.writer_lock:
+            self.writer_connection.close()
+
+    def insert_user(self, user_uuid: str, connection_hash: str, username: str = "", guest: bool = True) -> None:
+        # Reconnects only update the connection hash of the existing row.
+        self.write_user(user_uuid, insert={"username": username, "guest": int(guest)}, connection_hash=connection_hash)
+
+    def get_user(self, user_uuid: str) -> tuple | None:
+        return self.fetchone(SELECT_USER, (user_uuid,))
+
+    def set_game_code(self, user_uuid: str, game_code: str) -> None:
+        self.write_user(user_uuid, game_code=game_code)
+
+    def set_username(self, user_uuid: str, username: str) -> None:
+        self.write_user(user_uuid, username=username)
+
+    def claim_username(self, user_uuid: str, username: str, guest: bool) -> bool:
+        # Written straight away rather than journaled, so a name is held before its claim is answered.
+        # An empty name only gives up the one held.
+        try:
+            with self.writer_lock, self.writer_connection:
+                self.writer_connection.execute(DELETE_USERNAME, (user_uuid,))
+                if username:
+                    self.writer_connection.execute(INSERT_USERNAME, (username.casefold(), user_uuid, int(guest)))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def clear_guest_usernames(self) -> None:
+        # Guests never come back after a restart, so the names they held are free again.
+        with self.writer_lock, self.writer_connection:
+            self.writer_connection.execute(DELETE_GUEST_USERNAMES)
+            self.writer_connection.execute(CLEAR_GUEST_USERNAMES)
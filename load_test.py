@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import uuid
+
+from main import SERVER_PORT, RequestState, ResponseState, DataPacketState, GameWaitingState, WireFormat, \
+    WIRE_FORMAT, create_handshake, create_message, get_header_size, parse_header, decode_message, apply_patch
+
+# Run in the server subprocess, the certificate, key, mode and number of workers are passed as arguments.
+SERVER_SCRIPT = """
+import logging, sys
+from server import Server
+from sharding import FrontServer
+logging.disable(logging.CRITICAL)
+if sys.argv[3] == "sharded":
+    FrontServer(int(sys.argv[4]), ":memory:", sys.argv[1], sys.argv[2]).run()
+else:
+    Server(database_path=":memory:", certfile=sys.argv[1], keyfile=sys.argv[2]).run(asynchronous=sys.argv[3] == "async")
+"""
+
+# Packets that carry the whole game, patches that follow are made against them.
+GAME_DATA_STATES: tuple[str, ...] = (
+    DataPacketState.GAME_DATA.value, ResponseState.CREATE_GAME_SUCCESS.value, ResponseState.JOIN_GAME_SUCCESS.value,
+    ResponseState.GAME_DATA.value)
+MOVE_STATES: tuple[str, ...] = (
+    GameWaitingState.ROUND_START.value, GameWaitingState.PREDICTION.value, GameWaitingState.PLACE_CARD.value)
+
+
+def get_legal_cards(game_data: dict) -> list[dict]:
+    # Game data arrives as JSON, so rounds are keyed by strings.
+    hand = game_data["private"][str(game_data["round_number"])]["hand"]
+    if game_data["pile"]:
+        following = [card for card in hand if card["suit"] == game_data["pile"][0]["suit"]]
+        if following:
+            return following
+    return hand
+
+
+def create_certificate(directory: str) -> tuple[str, str]:
+    # A throwaway self-signed certificate, clients skip verification exactly like the real client does.
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+         "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def start_server(certfile: str, keyfile: str, mode: str, workers: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, certfile, keyfile, mode, str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    # Wait until the server accepts connections.
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}.")
+        try:
+            socket.create_connection((socket.gethostname(), SERVER_PORT), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start listening.")
+
+
+class ProcessStats:
+    # Usage of the server process and its children, so sharded workers are counted too.
+    def __init__(self, pid: int) -> None:
+        self.pid: int = pid
+        self.clock_ticks: int = os.sysconf("SC_CLK_TCK")
+
+    def get_pids(self) -> list[int]:
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as file:
+                    pids.extend(int(x) for x in file.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def get_cpu_time(self) -> float:
+        cpu_time = 0
+        for pid in self.get_pids():
+            with open(f"/proc/{pid}/stat") as file:
+                # The command name can contain spaces, so fields are counted from after its closing bracket.
+                fields = file.read().rsplit(")", 1)[1].split()
+            cpu_time += (int(fields[11]) + int(fields[12])) / self.clock_ticks
+        return cpu_time
+
+    def get_status(self) -> dict[str, int]:
+        # Memory in kB and thread counts summed over every process.
+        totals = {"VmRSS": 0, "VmHWM": 0, "Threads": 0, "Processes": 0}
+        for pid in self.get_pids():
+            with open(f"/proc/{pid}/status") as file:
+                status = dict(line.split(":", 1) for line in file.read().splitlines() if ":" in line)
+            for key in ("VmRSS", "VmHWM", "Threads"):
+                totals[key] += int(status[key].split()[0])
+            totals["Processes"] += 1
+        return totals
+
+
+class LoadClient:
+    def __init__(self, wire_format: WireFormat) -> None:
+        self.wire_format: WireFormat = wire_format
+        self.token: str = str(uuid.uuid4())
+        self.uuid: str = ""
+        self.reader: asyncio.StreamReader = ...
+        self.writer: asyncio.StreamWriter = ...
+        self.request_ids: typing.Iterator[int] = itertools.count(1)
+        self.pending: dict[int, asyncio.Future] = {}
+        self.uuid_received: asyncio.Event = asyncio.Event()
+        self.read_task: asyncio.Task | None = None
+        self.data_packets: int = 0
+        self.game_data: dict | None = None
+        self.game_updated: asyncio.Event = asyncio.Event()
+
+    async def connect(self, ssl_context: ssl.SSLContext) -> float:
+        # Setup time covers TCP, TLS, the token handshake and the server sending the UUID back.
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            socket.gethostname(), SERVER_PORT, ssl=ssl_context, server_hostname="localhost")
+        self.writer.write(create_handshake(self.token, self.wire_format))
+        self.read_task = asyncio.create_task(self.read_packets())
+        await self.uuid_received.wait()
+        return time.perf_counter() - start
+
+    async def read_packets(self) -> None:
+        try:
+            while True:
+                header = await self.reader.readexactly(get_header_size(self.wire_format))
+                header_message, length = parse_header(header, self.wire_format)
+                packet = decode_message(header_message, await self.reader.readexactly(length), self.wire_format)
+                if packet["state"] == DataPacketState.UUID.value:
+                    self.uuid = packet["data"]
+                    self.uuid_received.set()
+                    continue
+                self.update_game_data(packet)
+                if packet["state"].startswith("RS") and packet.get("id") in self.pending:
+                    self.pending.pop(packet["id"]).set_result(packet)
+                else:
+                    self.data_packets += 1
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            for future in self.pending.values():
+                future.cancel()
+
+    def update_game_data(self, packet: dict) -> None:
+        # Like the real client, a patch only applies to the version it was made from.
+        if packet["state"] in GAME_DATA_STATES:
+            self.game_data = packet["data"]
+        elif packet["state"] == DataPacketState.GAME_PATCH.value:
+            if self.game_data is None or self.game_data.get("version") != packet["data"]["base"]:
+                self.game_data = None
+            else:
+                apply_patch(self.game_data, packet["data"]["ops"])
+        else:
+            return
+        self.game_updated.set()
+
+    async def request(self, request_state: RequestState, data: typing.Any) -> tuple[str, typing.Any, float]:
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        start = time.perf_counter()
+        self.writer.write(create_message({"state": request_state.value, "data": data, "id": request_id},
+                                         self.wire_format))
+        packet = await future
+        return packet["state"], packet["data"], time.perf_counter() - start
+
+    async def close(self) -> None:
+        self.writer.close()
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+
+class LoadTest:
+    def __init__(self, server_stats: ProcessStats, tables: int, players: int, duration: float, think_time: float,
+                 wire_format: WireFormat, connect_concurrency: int, workload: str = "play",
+                 starting_cards: int = 0, seed: int = 0) -> None:
+        self.server_stats: ProcessStats = server_stats
+        self.tables: int = tables
+        self.players: int = players
+        self.duration: float = duration
+        self.think_time: float = think_time
+        self.wire_format: WireFormat = wire_format
+        self.connect_concurrency: int = connect_concurrency
+        self.workload: str = workload
+        self.starting_cards: int = starting_cards
+        self.random: random.Random = random.Random(seed)
+        self.games_finished: int = 0
+        self.setup_times: list[float] = []
+        # Round trips by request and the response state it was answered with.
+        self.latencies: dict[tuple[str, str], list[float]] = collections.defaultdict(list)
+        self.server_cpu_time: float = 0
+        self.wall_time: float = 0
+        self.server_status: dict[str, int] = {}
+        self.ssl_context: ssl.SSLContext = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def request(
+            self, client: LoadClient, request_state: RequestState, data: typing.Any) -> tuple[str, typing.Any]:
+        state, response_data, latency = await client.request(request_state, data)
+        self.latencies[request_state.name, state].append(latency)
+        return state, response_data
+
+    async def connect(self, client: LoadClient, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            self.setup_times.append(await client.connect(self.ssl_context))
+
+    async def play_table(self, clients: list[LoadClient], deadline: float) -> None:
+        host, *guests = clients
+        state, data = await self.request(host, RequestState.NEW_GAME, "")
+        if state != ResponseState.CREATE_GAME_SUCCESS.value:
+            raise RuntimeError(f"Could not create game: {state}")
+        for guest in guests:
+            await self.request(guest, RequestState.GAME_JOIN, data["code"])
+        await self.request(
+            host, RequestState.GAME_START, {"starting_cards": self.starting_cards, "trump_order": "HCDS-"})
+        if self.workload == "poll":
+            # Every seat keeps asking for the game state until the run ends.
+            await asyncio.gather(*(self.poll(client, deadline) for client in clients))
+            return
+        await asyncio.gather(*(self.play(client, deadline) for client in clients))
+        if host.game_data is not None and host.game_data["waiting_for"][1] == GameWaitingState.GAME_END.value:
+            self.games_finished += 1
+
+    async def play(self, client: LoadClient, deadline: float) -> None:
+        # Every seat plays its own turns as soon as the game data it was sent says it is their move.
+        while time.monotonic() < deadline:
+            if client.game_data is None:
+                await self.request(client, RequestState.GAME_DATA, "")
+                continue
+            player_uuid, state = client.game_data["waiting_for"]
+            if state == GameWaitingState.GAME_END.value:
+                return
+            if player_uuid != client.uuid or state not in MOVE_STATES:
+                client.game_updated.clear()
+                try:
+                    await asyncio.wait_for(client.game_updated.wait(), deadline - time.monotonic())
+                except TimeoutError:
+                    return
+                continue
+            await asyncio.sleep(self.think_time)
+            await self.make_move(client, state)
+
+    async def make_move(self, client: LoadClient, state: str) -> None:
+        game_data = client.game_data
+        if state == GameWaitingState.ROUND_START.value:
+            await self.request(client, RequestState.ROUND_START, "")
+        elif state == GameWaitingState.PREDICTION.value:
+            # Predictions in the order they are tried, the server rejects the one the last player may not make.
+            predictions = list(range(game_data["tricks_available"] + 1))
+            self.random.shuffle(predictions)
+            for prediction in predictions:
+                response_state, _ = await self.request(client, RequestState.PREDICTION, prediction)
+                if response_state != ResponseState.INVALID_PREDICTION.value:
+                    break
+        else:
+            await self.request(client, RequestState.PLACE_CARD, self.random.choice(get_legal_cards(game_data)))
+
+    async def poll(self, client: LoadClient, deadline: float) -> None:
+        while time.monotonic() < deadline:
+            await self.request(client, RequestState.GAME_DATA, "")
+            await asyncio.sleep(self.think_time)
+
+    async def run(self) -> None:
+        clients = [LoadClient(self.wire_format) for _ in range(self.tables * self.players)]
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+        cpu_time = self.server_stats.get_cpu_time()
+        start = time.perf_counter()
+        await asyncio.gather(*(self.connect(client, semaphore) for client in clients))
+        print(f"Connected {len(clients)} clients in {time.perf_counter() - start:.2f} s.")
+
+        deadline = time.monotonic() + self.duration
+        await asyncio.gather(*(self.play_table(clients[i:i + self.players], deadline)
+                               for i in range(0, len(clients), self.players)))
+        # Server usage is read while every client is still connected.
+        self.server_cpu_time = self.server_stats.get_cpu_time() - cpu_time
+        self.wall_time = time.perf_counter() - start
+        self.server_status = self.server_stats.get_status()
+        await asyncio.gather(*(client.close() for client in clients))
+
+
+def get_percentile(values: list[float], fraction: float) -> float:
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def format_latencies(values: list[float]) -> str:
+    values = sorted(values)
+    return (f"n={len(values)} p50={get_percentile(values, 0.5) * 1e3:.2f} ms "
+            f"p90={get_percentile(values, 0.9) * 1e3:.2f} ms p99={get_percentile(values, 0.99) * 1e3:.2f} ms "
+            f"max={values[-1] * 1e3:.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test a local server with simulated TLS clients.")
+    parser.add_argument("--tables", type=int, default=10)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--think-time", type=float, default=0.05)
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--mode", choices=["threaded", "async", "sharded"], default="threaded")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--wire-format", choices=[x.value for x in WireFormat], default=WIRE_FORMAT.value)
+    parser.add_argument("--workload", choices=["play", "poll"], default="play")
+    parser.add_argument("--starting-cards", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = create_certificate(directory)
+        server = start_server(certfile, keyfile, arguments.mode, arguments.workers)
+        try:
+            load_test = LoadTest(
+                ProcessStats(server.pid), arguments.tables, arguments.players, arguments.duration,
+                arguments.think_time, WireFormat(arguments.wire_format), arguments.connect_concurrency,
+                arguments.workload, arguments.starting_cards, arguments.seed)
+            asyncio.run(load_test.run())
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"Connection setup: {format_latencies(load_test.setup_times)}")
+    for (name, state), values in sorted(
+            load_test.latencies.items(), key=lambda x: (int(RequestState[x[0][0]].value[2:]), int(x[0][1][2:]))):
+        print(f"{name} {ResponseState(state).name}: {format_latencies(values)}")
+    if load_test.workload == "play":
+        # Only moves the server accepted are counted.
+        moves = sum(len(load_test.latencies[x.name, ResponseState.SUCCESS.value]) for x in (
+            RequestState.ROUND_START, RequestState.PREDICTION, RequestState.PLACE_CARD))
+        print(f"Finished {load_test.games_finished} of {load_test.tables} games, "
+              f"{moves / load_test.wall_time:.0f} moves/s")
+    status = load_test.server_status
+    print(f"Server CPU: {load_test.server_cpu_time:.2f} s over {load_test.wall_time:.2f} s "
+          f"({load_test.server_cpu_time / load_test.wall_time * 100:.0f}% of one core), RSS {status["VmRSS"]} kB, "
+          f"peak RSS {status["VmHWM"]} kB, {status["Threads"]} threads in {status["Processes"]} processes")
+
+
+if __name__ == "__main__":
+    main()
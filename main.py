@@ -1,10 +1,15 @@
+import collections
+import itertools
 import json
 import logging
 import os
+import socket
 import ssl
+import struct
 import threading
 import time
 import typing
+import zlib
 from enum import Enum
 
 from dotenv import load_dotenv
@@ -19,7 +24,15 @@ DB = os.getenv("DB")
 SERVER_PORT = 8108
 SERVER_IP = "127.0.0.1"
 HEADER_SIZE = 8
+BINARY_MAGIC = 0xB1
+BINARY_HEADER = struct.Struct("!BBII")
 GAME_CODE_LENGTH = 4
+REQUEST_PIPELINE_DEPTH = 4
+MAX_OUTBOUND_BYTES = 1 << 20
+# Seconds of silence before a peer is asked for a heartbeat, and before it is dropped.
+HEARTBEAT_INTERVAL = 15.0
+IDLE_TIMEOUT = 45.0
+HANDSHAKE_TIMEOUT = 10.0
 
 
 class PacketState(Enum):
@@ -32,6 +45,12 @@ class RequestState(PacketState):
     GAME_START = "RQ3"
     GAME_DATA = "RQ4"
     UUID = "RQ5"
+    ROUND_START = "RQ6"
+    PREDICTION = "RQ7"
+    PLACE_CARD = "RQ8"
+    FIND_GAME = "RQ9"
+    LOBBY_LIST = "RQ10"
+    SET_USERNAME = "RQ11"
 
 
 class ResponseState(PacketState):
@@ -52,12 +71,26 @@ class ResponseState(PacketState):
     INVALID_CARD = "RS15"
     INVALID_PREDICTION = "RS16"
     SUCCESS = "RS17"
+    LOBBY_LIST = "RS18"
+    USERNAME_TAKEN = "RS19"
+    INVALID_USERNAME = "RS20"
 
 
 class DataPacketState(PacketState):
     GAME_DATA = "DP1"
     UUID = "DP2"
     TOKEN = "DP3"
+    GAME_PATCH = "DP4"
+    HEARTBEAT = "DP5"
+
+
+class WireFormat(Enum):
+    JSON = "JSON"
+    BINARY = "BINARY"
+
+
+# Wire format offered by clients, the server answers each client in the format it connected with.
+WIRE_FORMAT = WireFormat.BINARY
 
 
 class GameWaitingState(Enum):
@@ -71,31 +104,144 @@ class GameWaitingState(Enum):
 
 
 class NetworkConnection:
-    def __init__(self, peer_socket: ssl.SSLSocket, peer_address):
+    def __init__(
+            self, peer_socket: ssl.SSLSocket, peer_address, wire_format: WireFormat = WireFormat.JSON,
+            pipeline_depth: int = REQUEST_PIPELINE_DEPTH, max_outbound_bytes: int = MAX_OUTBOUND_BYTES):
         self.socket: ssl.SSLSocket = peer_socket
         self.address = peer_address
-        self.requests: list[tuple] = []
-        self.has_responded: bool = True
-        threading.Thread(target=self.loop_requests).start()
-
-    def send_packet(self, packet_state: PacketState, data: typing.Any) -> None:
+        self.wire_format: WireFormat = wire_format
+        # When the last packet arrived from the peer, any packet counts as a heartbeat.
+        self.last_received: float = time.monotonic()
+
+        # Outbound messages are buffered per connection so a broadcast never waits on a slow peer.
+        self.outbound: collections.deque[bytes] = collections.deque()
+        self.outbound_size: int = 0
+        self.max_outbound_bytes: int = max_outbound_bytes
+        self.outbound_condition: threading.Condition = threading.Condition()
+        self.outbound_thread: threading.Thread | None = None
+        self.closed: bool = False
+
+        # Outbound requests wait in the queue until fewer than pipeline_depth are awaiting a response.
+        self.requests: collections.deque[tuple[int, RequestState, typing.Any]] = collections.deque()
+        self.pending_responses: dict[int, RequestState] = {}
+        self.pipeline_depth: int = pipeline_depth
+        self.request_ids: typing.Iterator[int] = itertools.count(1)
+        self.request_condition: threading.Condition = threading.Condition()
+        self.request_thread: threading.Thread | None = None
+
+    def send_packet(self, packet_state: PacketState, data: typing.Any, packet_id: int | None = None) -> None:
         logging.info(f"Sent packet {packet_state.value}.")
-        self.socket.sendall(create_message({"state": packet_state.value, "data": data}))
+        message = {"state": packet_state.value, "data": data}
+        if packet_id is not None:
+            message["id"] = packet_id
+        self.send_bytes(create_message(message, self.wire_format))
 
-    def request(self, request_state: RequestState, data: typing.Any) -> None:
-        self.requests.append((request_state, data))
-
-    def respond(self, response_state: ResponseState, data: typing.Any) -> None:
-        self.send_packet(response_state, data)
+    def send_encoded(self, packet_state: PacketState, payload: bytes, packet_id: int | None = None) -> None:
+        logging.info(f"Sent packet {packet_state.value}.")
+        self.send_bytes(create_encoded_message(packet_state.value, payload, packet_id, self.wire_format))
+
+    def send_bytes(self, data: bytes) -> None:
+        # Sockets that never block buffer writes themselves, everything else goes through the writer thread.
+        if not self.socket.getblocking():
+            self.socket.sendall(data)
+            return
+        with self.outbound_condition:
+            if self.closed:
+                return
+            # Check if the peer has fallen too far behind to ever catch up.
+            if self.outbound_size + len(data) > self.max_outbound_bytes:
+                logging.warning(f"Disconnecting {self.address}, {self.outbound_size} bytes are waiting to be sent.")
+                self.close()
+                return
+            self.outbound.append(data)
+            self.outbound_size += len(data)
+            self.outbound_condition.notify()
+            if self.outbound_thread is None or not self.outbound_thread.is_alive():
+                self.outbound_thread = threading.Thread(target=self.loop_outbound, daemon=True)
+                self.outbound_thread.start()
+
+    def loop_outbound(self) -> None:
+        while True:
+            with self.outbound_condition:
+                self.outbound_condition.wait_for(lambda: self.outbound or self.closed)
+                if self.closed:
+                    return
+                # Everything queued since the last write is sent in one call.
+                data = b"".join(self.outbound)
+                self.outbound.clear()
+                self.outbound_size = 0
+                peer_socket = self.socket
+            try:
+                peer_socket.sendall(data)
+            except OSError as e:
+                logging.error(f"Failed to send to {self.address}: {e}")
+                self.close()
+                return
+
+    def reset_outbound(self) -> None:
+        # Called when the connection gets a new socket, anything queued for the old one is stale.
+        with self.outbound_condition:
+            self.outbound.clear()
+            self.outbound_size = 0
+            self.closed = False
+            self.outbound_condition.notify()
+
+    def close(self) -> None:
+        with self.outbound_condition:
+            self.closed = True
+            self.outbound_condition.notify()
+        with self.request_condition:
+            self.request_condition.notify()
+        # Sessions restored without a client have no socket yet.
+        if self.socket is None:
+            return
+        # Shutting the socket down first also wakes any thread blocked reading from it.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def request(self, request_state: RequestState, data: typing.Any) -> int:
+        with self.request_condition:
+            request_id = next(self.request_ids)
+            self.requests.append((request_id, request_state, data))
+            self.request_condition.notify()
+        # Only connections that actually send requests need a thread to pace them.
+        if self.request_thread is None or not self.request_thread.is_alive():
+            self.request_thread = threading.Thread(target=self.loop_requests, daemon=True)
+            self.request_thread.start()
+        return request_id
+
+    def respond(self, response_state: ResponseState, data: typing.Any, request_id: int | None = None) -> None:
+        self.send_packet(response_state, data, request_id)
+
+    def response_received(self, request_id: int | None = None) -> None:
+        with self.request_condition:
+            if request_id in self.pending_responses:
+                self.pending_responses.pop(request_id)
+            elif self.pending_responses:
+                # A response without a known ID answers the oldest outstanding request.
+                self.pending_responses.pop(next(iter(self.pending_responses)))
+            self.request_condition.notify()
+
+    def reset_requests(self) -> None:
+        with self.request_condition:
+            self.pending_responses.clear()
+            self.request_condition.notify()
+
+    def can_send_request(self) -> bool:
+        return len(self.requests) > 0 and len(self.pending_responses) < self.pipeline_depth
 
     def loop_requests(self):
         while True:
-            if self.has_responded and len(self.requests) > 0:
-                self.has_responded = False
-                request = self.requests.pop(0)
-                self.send_packet(request[0], request[1])
-            else:
-                time.sleep(0.1)
+            with self.request_condition:
+                self.request_condition.wait_for(lambda: self.can_send_request() or self.closed)
+                if self.closed:
+                    return
+                request_id, request_state, data = self.requests.popleft()
+                self.pending_responses[request_id] = request_state
+            self.send_packet(request_state, data, request_id)
 
     def __str__(self):
         return self.address
@@ -103,19 +249,25 @@ class NetworkConnection:
 
 class ConnectionToClient(NetworkConnection):
     def __init__(
-            self, client_socket: ssl.SSLSocket, client_address, hashed_token: str, client_uuid: str):
-        super().__init__(client_socket, client_address)
+            self, client_socket: ssl.SSLSocket, client_address, hashed_token: str, client_uuid: str,
+            wire_format: WireFormat = WireFormat.JSON):
+        super().__init__(client_socket, client_address, wire_format)
         self.hashed_token: str = hashed_token
         self.uuid: str = client_uuid
         self.in_game: str = ""
+        # Last game data sent to the client, game updates are sent as patches against it.
+        self.game_data: dict | None = None
+        # Requests received from the client, the first is being handled and the rest wait until it is answered.
+        self.requests_received: collections.deque[dict] = collections.deque()
+        self.requests_received_lock: threading.Lock = threading.Lock()
 
     def __repr__(self):
         return self.uuid
 
 
 class ConnectionToServer(NetworkConnection):
-    def __init__(self, server_socket: ssl.SSLSocket, server_address):
-        super().__init__(server_socket, server_address)
+    def __init__(self, server_socket: ssl.SSLSocket, server_address, wire_format: WireFormat = WireFormat.JSON):
+        super().__init__(server_socket, server_address, wire_format)
 
 
 def recvall(s: ssl.SSLSocket, n: int) -> bytes:
@@ -128,12 +280,183 @@ def recvall(s: ssl.SSLSocket, n: int) -> bytes:
     return data
 
 
-def create_message(message: dict) -> bytes:
+def get_header_size(wire_format: WireFormat) -> int:
+    if wire_format == WireFormat.BINARY:
+        return BINARY_HEADER.size
+    return HEADER_SIZE
+
+
+def get_wire_format(first_byte: bytes) -> WireFormat:
+    # JSON headers are ASCII digits, so the magic byte can never start one.
+    if first_byte and first_byte[0] == BINARY_MAGIC:
+        return WireFormat.BINARY
+    return WireFormat.JSON
+
+
+def parse_header(header: bytes, wire_format: WireFormat) -> tuple[dict, int]:
+    # Returns the part of the message carried by the header and the size of the payload.
+    if wire_format == WireFormat.BINARY:
+        magic, packet_type, packet_id, length = BINARY_HEADER.unpack(header)
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"Invalid header magic {magic}.")
+        message = {"state": get_packet_code(packet_type)}
+        if packet_id:
+            message["id"] = packet_id
+        return message, length
+    return {}, int(header.decode())
+
+
+def encode_data(data: typing.Any) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def create_message(message: dict, wire_format: WireFormat = WireFormat.JSON) -> bytes:
+    if wire_format == WireFormat.BINARY:
+        # The state and request ID live in the header, only the data is serialized.
+        return create_encoded_message(message["state"], encode_data(message["data"]), message.get("id"), wire_format)
     json_message = json.dumps(message).encode()
     return f"{len(json_message):<8}".encode() + json_message
 
 
+def create_encoded_message(
+        packet_code: str, payload: bytes, packet_id: int | None = None,
+        wire_format: WireFormat = WireFormat.JSON) -> bytes:
+    # Frames data that was already encoded, so shared payloads are only serialized once.
+    if wire_format == WireFormat.BINARY:
+        return BINARY_HEADER.pack(BINARY_MAGIC, get_packet_type(packet_code), packet_id or 0, len(payload)) + payload
+    id_field = f', "id": {packet_id}' if packet_id is not None else ""
+    json_message = f'{{"state": "{packet_code}"{id_field}, "data": '.encode() + payload + b"}"
+    return f"{len(json_message):<8}".encode() + json_message
+
+
+def decode_message(header_message: dict, payload: bytes, wire_format: WireFormat) -> dict:
+    if wire_format == WireFormat.BINARY:
+        header_message["data"] = json.loads(payload)
+        return header_message
+    return json.loads(payload)
+
+
+def read_message(s: ssl.SSLSocket, wire_format: WireFormat) -> dict | None:
+    header: bytes = recvall(s, get_header_size(wire_format))
+    if len(header) < get_header_size(wire_format):
+        return None
+    header_message, length = parse_header(header, wire_format)
+    return decode_message(header_message, recvall(s, length), wire_format)
+
+
+def get_shard(key: str, number_of_shards: int) -> int:
+    # Stable across processes and runs, unlike hash() on strings.
+    return zlib.crc32(key.encode()) % number_of_shards
+
+
+def diff_data(old: dict, new: dict, path: tuple = ()) -> list[list]:
+    # Patch operations are [path, value] to set a value and [path] to delete a key.
+    operations = []
+    for key, value in new.items():
+        if key not in old:
+            operations.append([[*path, key], value])
+        elif old[key] is value:
+            continue
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            operations.extend(diff_data(old[key], value, (*path, key)))
+        elif old[key] != value:
+            operations.append([[*path, key], value])
+    for key in old:
+        if key not in new:
+            operations.append([[*path, key]])
+    return operations
+
+
+def apply_patch(data: dict, operations: list[list]) -> None:
+    for operation in operations:
+        # Keys are compared as strings because JSON turns every dictionary key into one.
+        *parents, key = [str(x) for x in operation[0]]
+        node = data
+        for parent in parents:
+            node = node[parent]
+        if len(operation) == 1:
+            node.pop(key, None)
+        else:
+            node[key] = operation[1]
+
+
+def create_handshake(token: str, wire_format: WireFormat) -> bytes:
+    encoded_token = token.encode()
+    if wire_format == WireFormat.BINARY:
+        return BINARY_HEADER.pack(
+            BINARY_MAGIC, get_packet_type(DataPacketState.TOKEN.value), 0, len(encoded_token)) + encoded_token
+    return f"{len(encoded_token):<8}".encode() + encoded_token
+
+
+def read_handshake(s: ssl.SSLSocket) -> tuple[WireFormat, bytes]:
+    first_byte: bytes = recvall(s, 1)
+    wire_format = get_wire_format(first_byte)
+    header = first_byte + recvall(s, get_header_size(wire_format) - 1)
+    return wire_format, recvall(s, parse_header(header, wire_format)[1])
+
+
 SUITS: list[str] = ["H", "C", "D", "S"]
 VALUES: list[str] = ["2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14"]
 
 FULL_DECK: list[dict] = [{"suit": suit, "value": value} for suit in SUITS for value in VALUES]
+
+# Inside the game engine a card is its index in FULL_DECK and a hand is a bitmask with one bit per card.
+DECK_SIZE = len(FULL_DECK)
+CARD_NUMBERS: dict[tuple[str, str], int] = {(card["suit"], card["value"]): i for i, card in enumerate(FULL_DECK)}
+SUIT_MASKS: list[int] = [((1 << len(VALUES)) - 1) << (i * len(VALUES)) for i in range(len(SUITS))]
+
+
+def get_card_suit(card: int) -> int:
+    return card // len(VALUES)
+
+
+def get_card_rank(card: int) -> int:
+    return card % len(VALUES)
+
+
+def card_to_dict(card: int) -> dict:
+    return dict(FULL_DECK[card])
+
+
+def card_from_dict(card: typing.Any) -> int | None:
+    # Cards from the network are only trusted once they match a card in the deck.
+    if not isinstance(card, dict):
+        return None
+    return CARD_NUMBERS.get((card.get("suit"), card.get("value")))
+
+
+def get_trick_winner(cards: typing.Sequence[int], trump_suit: int) -> int:
+    # Returns the position of the winning card, a trump suit of -1 means there are no trumps this round.
+    winner = 0
+    winning_suit = get_card_suit(cards[0])
+    for i in range(1, len(cards)):
+        suit = get_card_suit(cards[i])
+        # Cards of one suit are numbered in rank order, so following the best card only needs a higher number.
+        if suit == winning_suit:
+            if cards[i] > cards[winner]:
+                winner = i
+        elif suit == trump_suit:
+            winner, winning_suit = i, suit
+    return winner
+
+
+def get_hand_cards(hand: int) -> list[int]:
+    cards = []
+    while hand:
+        lowest = hand & -hand
+        cards.append(lowest.bit_length() - 1)
+        hand ^= lowest
+    return cards
+
+
+# Packet states are sent as one byte, the category in the top two bits and the number in the rest.
+PACKET_CATEGORIES: dict[str, int] = {"RQ": 0x00, "RS": 0x40, "DP": 0x80}
+PACKET_PREFIXES: dict[int, str] = {value: key for key, value in PACKET_CATEGORIES.items()}
+
+
+def get_packet_type(packet_code: str) -> int:
+    return PACKET_CATEGORIES[packet_code[:2]] | int(packet_code[2:])
+
+
+def get_packet_code(packet_type: int) -> str:
+    return PACKET_PREFIXES[packet_type & 0xC0] + str(packet_type & 0x3F)
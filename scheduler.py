@@ -0,0 +1,120 @@
+import collections
+import concurrent.futures
+import logging
+import math
+import threading
+import time
+import typing
+
+TICK_INTERVAL = 0.5
+WHEEL_SLOTS = 512
+# Tasks a mailbox runs before handing its executor thread to the next one.
+MAILBOX_BATCH = 32
+
+
+class Timer:
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick: int, callback: typing.Callable[..., None], args: tuple) -> None:
+        self.tick: int = tick
+        self.callback: typing.Callable[..., None] = callback
+        self.args: tuple = args
+        self.cancelled: bool = False
+
+    def cancel(self) -> None:
+        # Cancelled timers stay in their slot and are skipped when it comes round.
+        self.cancelled = True
+
+
+class TimerWheel:
+    # Every timer of the server shares one thread, timers are hashed into slots by the tick they are due on.
+    def __init__(self, tick_interval: float = TICK_INTERVAL, slots: int = WHEEL_SLOTS) -> None:
+        self.tick_interval: float = tick_interval
+        self.slots: list[list[Timer]] = [[] for _ in range(slots)]
+        self.start_time: float = time.monotonic()
+        # The last tick whose slot has been run.
+        self.current_tick: int = 0
+        self.timers: int = 0
+
+        self.condition: threading.Condition = threading.Condition()
+        self.closing: bool = False
+        self.thread: threading.Thread | None = None
+
+    def schedule(self, delay: float, callback: typing.Callable[..., None], *args: typing.Any) -> Timer:
+        # Timers fire on the first tick at or after their deadline, so never early and at most one tick late.
+        with self.condition:
+            tick = max(math.ceil((time.monotonic() + delay - self.start_time) / self.tick_interval),
+                       self.current_tick + 1)
+            timer = Timer(tick, callback, args)
+            self.slots[tick % len(self.slots)].append(timer)
+            self.timers += 1
+            self.condition.notify()
+            # The thread is only started once something is scheduled.
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop_ticks, daemon=True)
+                self.thread.start()
+        return timer
+
+    def loop_ticks(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.timers or self.closing)
+                if self.closing:
+                    return
+                # Sleep until the next tick is due, new timers can only be due later than that.
+                delay = self.start_time + (self.current_tick + 1) * self.tick_interval - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                # Timers more than one revolution away stay in the slot until their own tick.
+                due = [timer for timer in slot if timer.tick <= self.current_tick]
+                slot[:] = [timer for timer in slot if timer.tick > self.current_tick]
+                self.timers -= len(due)
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    logging.error(f"Timer {timer.callback.__name__} failed: {e}")
+
+    def close(self) -> None:
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Mailbox:
+    # Tasks posted to one mailbox run one at a time in the order they were posted, on an executor shared by many.
+    def __init__(self, executor: concurrent.futures.Executor) -> None:
+        self.executor: concurrent.futures.Executor = executor
+        self.tasks: collections.deque[tuple[typing.Callable[..., None], tuple]] = collections.deque()
+        # Only guards this mailbox, so posting to one never waits on another.
+        self.lock: threading.Lock = threading.Lock()
+        self.running: bool = False
+
+    def post(self, callback: typing.Callable[..., None], *args: typing.Any) -> None:
+        with self.lock:
+            self.tasks.append((callback, args))
+            if self.running:
+                return
+            self.running = True
+        self.executor.submit(self.run_tasks)
+
+    def run_tasks(self) -> None:
+        for _ in range(MAILBOX_BATCH):
+            with self.lock:
+                if not self.tasks:
+                    self.running = False
+                    return
+                callback, args = self.tasks.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.error(f"Task {callback.__name__} failed: {e}")
+        # A busy mailbox goes to the back of the executor queue so other mailboxes get a turn.
+        self.executor.submit(self.run_tasks)
@@ -1,46 +1,166 @@
-import copy
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import hashlib
-import json
+import itertools
 import logging
 import random
+import secrets
 import socket
 import ssl
 import string
+import sys
 import threading
+import time
 import typing
 import uuid
 
-import sqlite3
-
-from main import ConnectionToClient, SERVER_PORT, DB_HOST, DB_USERNAME, DB_PASSWORD, DB, recvall, HEADER_SIZE, \
-    ResponseState, RequestState, DataPacketState, GAME_CODE_LENGTH, FULL_DECK, GameWaitingState
+from database import Database, FLUSH_INTERVAL
+from scheduler import Mailbox, Timer, TimerWheel
+from snapshots import GameStore, SNAPSHOT_INTERVAL
+from main import ConnectionToClient, SERVER_PORT, DB_HOST, DB_USERNAME, DB_PASSWORD, DB, ResponseState, RequestState, \
+    DataPacketState, GAME_CODE_LENGTH, MAX_OUTBOUND_BYTES, HEARTBEAT_INTERVAL, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT, \
+    DECK_SIZE, SUITS, SUIT_MASKS, GameWaitingState, WireFormat, \
+    read_handshake, read_message, get_wire_format, get_header_size, parse_header, decode_message, diff_data, \
+    encode_data, card_to_dict, card_from_dict, get_card_suit, get_card_rank, get_trick_winner, get_hand_cards, \
+    get_shard
 
 logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.DEBUG)
 
+# How long a dropped client can come back and resume its session, and how many sessions are kept at most.
+RECONNECT_TTL = 300.0
+RECONNECT_MAX_SIZE = 10000
+RECONNECT_SWEEP_INTERVAL = 10.0
+# How long a player has to make their move before one is made for them, None turns deadlines off.
+TURN_TIMEOUT = 60.0
+TIMED_STATES: tuple[GameWaitingState, ...] = (
+    GameWaitingState.ROUND_START, GameWaitingState.PREDICTION, GameWaitingState.PLACE_CARD)
+# Threads shared by every game's mailbox.
+GAME_WORKERS = 8
+# Requests that read or change a game, they are handled on that game's mailbox.
+GAME_REQUESTS: tuple[str, ...] = (
+    RequestState.GAME_JOIN.value, RequestState.GAME_START.value, RequestState.GAME_DATA.value,
+    RequestState.ROUND_START.value, RequestState.PREDICTION.value, RequestState.PLACE_CARD.value)
+
+# Game methods that are logged as moves and replayed when games are restored.
+REPLAYED_MOVES: tuple[str, ...] = (
+    "set_lobby_settings", "add_player", "remove_player", "rename_player", "set_up_game", "start_round",
+    "make_prediction", "place_card")
+# Public lobbies a client tries to join before matchmaking opens a new one, and the most listed at once.
+MATCHMAKING_ATTEMPTS = 3
+LOBBY_PAGE_SIZE = 50
+USERNAME_MAX_LENGTH = 20
+# Rounds of the Feistel network that orders game codes.
+CODE_ROUNDS = 4
+
 
 class Server:
-    def __init__(self) -> None:
-        self.database_connection = sqlite3.connect("BlobDB.db", check_same_thread=False)
-        self.database = self.database_connection.cursor()
-        logging.info(f"Connected to database.")
+    def __init__(
+            self, database_path: str = "BlobDB.db", certfile: str = r"resources\ssl-tls\fullchain.pem",
+            keyfile: str = r"resources\ssl-tls\privkey.pem", database_flush_interval: float = FLUSH_INTERVAL,
+            shard: tuple[int, int] | None = None, snapshot_directory: str | None = None,
+            snapshot_interval: float = SNAPSHOT_INTERVAL, reconnect_ttl: float = RECONNECT_TTL,
+            reconnect_max_size: int = RECONNECT_MAX_SIZE, heartbeat_interval: float = HEARTBEAT_INTERVAL,
+            idle_timeout: float = IDLE_TIMEOUT, turn_timeout: float | None = TURN_TIMEOUT,
+            game_workers: int = GAME_WORKERS, game_code_length: int = GAME_CODE_LENGTH) -> None:
+        self.database: Database = Database(database_path, database_flush_interval)
+        # Shards are started by a front process, which frees guest names once before any of them start.
+        if shard is None:
+            self.database.clear_guest_usernames()
+        # Games are only persisted when a snapshot directory is given.
+        self.game_store: GameStore | None = GameStore(snapshot_directory, snapshot_interval) \
+            if snapshot_directory else None
+        self.restoring: bool = False
+        # One timer thread for the whole server, idle checks and sweeps never get a thread each.
+        self.scheduler: TimerWheel = TimerWheel()
+        self.heartbeat_interval: float = heartbeat_interval
+        self.idle_timeout: float = idle_timeout
+        self.turn_timeout: float | None = turn_timeout
+        # Every change to a game runs on its mailbox, the mailboxes share these threads.
+        self.executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(game_workers)
+        # Idle checks of connected clients by hashed token.
+        self.idle_timers: dict[str, Timer] = {}
 
         # Initialize managers.
         self.user_manager: UserManager = UserManager(self)
-        self.game_manager: GameManager = GameManager(self)
+        self.game_manager: GameManager = GameManager(self, shard, game_code_length)
         self.controller: Controller = Controller(self)
 
         # Declare dictionaries of clients and games.
         self.clients: dict[str, ConnectionToClient] = {}
-        self.disconnected_clients: dict[str, ConnectionToClient] = {}
+        self.disconnected_clients: ReconnectionStore = ReconnectionStore(
+            self.evict_client, reconnect_ttl, reconnect_max_size)
+        self.scheduler.schedule(RECONNECT_SWEEP_INTERVAL, self.sweep_disconnected_clients)
+
+        self.certfile: str = certfile
+        self.keyfile: str = keyfile
 
+        if self.game_store is not None:
+            self.restore_games()
+
+    def run(self, asynchronous: bool = False) -> None:
         # Create SSL context and load certificate and key.
         self.ssl_context: ssl.SSLContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.ssl_context.load_cert_chain(
-            certfile=r"resources\ssl-tls\fullchain.pem",
-            keyfile=r"resources\ssl-tls\privkey.pem")
+        self.ssl_context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
 
+        try:
+            if asynchronous:
+                asyncio.run(self.serve())
+            else:
+                self.serve_threaded()
+        finally:
+            # Timers and mailbox tasks still write to the game store and the database, so they are stopped first.
+            self.scheduler.close()
+            self.executor.shutdown(wait=True)
+            if self.game_store is not None:
+                self.game_store.close()
+            # Write out anything still waiting in the database journal.
+            self.database.close()
+
+    def restore_games(self) -> None:
+        # Rebuild every stored game from its snapshot and the moves logged after it.
+        start = time.perf_counter()
+        for game_code, snapshot, moves in self.game_store.load_games():
+            game = Game(self.game_manager, game_code)
+            if snapshot is not None:
+                game.load_snapshot(snapshot)
+            self.restoring = True
+            try:
+                for version, kind, args in moves:
+                    if version >= game.version and kind in REPLAYED_MOVES:
+                        getattr(game, kind)(*args)
+            except Exception as e:
+                logging.error(f"Failed to replay moves for game {game_code}: {e}")
+                continue
+            finally:
+                self.restoring = False
+            if not game.players:
+                continue
+            (self.game_manager.started if game.started else self.game_manager.lobbies)[game_code] = game
+            self.game_manager.code_allocator.reserve(game_code)
+            self.game_manager.public_lobbies.update(game)
+            # Start again from a fresh snapshot so the replayed moves are not replayed twice after another restart.
+            self.game_store.save_snapshot(game_code, game.get_snapshot())
+            game.set_turn_deadline()
+
+            # Players resume through the usual reconnect path once their client connects with the same token.
+            for player_uuid in game.players:
+                hashed_token = self.controller.get_connection_hash(player_uuid)
+                if hashed_token and hashed_token not in self.disconnected_clients:
+                    client = ConnectionToClient(None, None, hashed_token, player_uuid)
+                    client.in_game = game_code
+                    self.disconnected_clients[hashed_token] = client
+        logging.info(f"Restored {len(self.game_manager.lobbies) + len(self.game_manager.started)} games in "
+                     f"{time.perf_counter() - start:.2f} s.")
+
+    def serve_threaded(self) -> None:
         # Create socket
-        self.socket: ssl.SSLSocket = self.ssl_context.wrap_socket(socket.socket(), server_side=True)
+        # The TLS handshake is left to the client thread, so a stalled client cannot block accepting others.
+        self.socket: ssl.SSLSocket = self.ssl_context.wrap_socket(
+            socket.socket(), server_side=True, do_handshake_on_connect=False)
+        # Allow restarting straight away while connections from the last run are still in TIME_WAIT.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         # Bind socket to hostname and server port.
         try:
@@ -67,74 +187,181 @@ class Server:
                 logging.error(f"Unexpected error: {e}")
 
     def client_thread(self, client_socket: ssl.SSLSocket, client_address) -> None:
-        # Receive connection token from client and hash it.
-        hashed_token: str = hashlib.sha256(
-            recvall(client_socket, int(client_socket.recv(HEADER_SIZE).decode()))).hexdigest()
-
-        # Check if the client has been previously connected and respond accordingly.
-        if hashed_token in self.disconnected_clients:
-            self.clients[hashed_token] = self.reconnect(
-                client_socket=client_socket, hashed_token=hashed_token)
-            logging.info(f"Reconnected to client: {self.clients[hashed_token].uuid}, Sending UUID...")
-        else:
-            self.clients[hashed_token] = ConnectionToClient(
-                client_socket, client_address, hashed_token, str(uuid.uuid4()))
-            logging.info(f"Connected to client: {self.clients[hashed_token].uuid}, Sending UUID...")
-        client: ConnectionToClient = self.clients[hashed_token]
-        client.send_packet(DataPacketState.UUID, client.uuid)
-        self.database.execute(
-            f"""INSERT INTO Users (uuid, username, connection_hash, guest, password_salt, password_hash) 
-            VALUES ('{self.clients[hashed_token].uuid}', '', '{hashed_token}', 1, NULL, NULL);""")
+        try:
+            # Clients that never finish the TLS handshake or never send their token give up the thread.
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            client_socket.do_handshake()
+            # Receive connection token from client and hash it, the token header decides the wire format.
+            wire_format, token = read_handshake(client_socket)
+            hashed_token: str = hashlib.sha256(token).hexdigest()
+            # Once connected, silent clients are found by the idle checks instead.
+            client_socket.settimeout(None)
+        except Exception as e:
+            logging.error(f"Failed to receive connection token from {client_address}: {e}")
+            client_socket.close()
+            return
+        client: ConnectionToClient = self.connect_client(client_socket, client_address, hashed_token, wire_format)
 
-        # Receive data from client and start a new thread to handle each packet.
+        # Receive data from client and handle each packet in the order it arrived.
         while True:
             try:
-                # Receive header with size of the rest of the message.
-                header: bytes = recvall(client.socket, HEADER_SIZE)
+                packet: dict | None = read_message(client_socket, wire_format)
 
-                # Break from the loop if the header is empty.
-                if not len(header):
+                # Break from the loop if the connection was closed.
+                if packet is None:
                     break
-                packet: dict = json.loads(recvall(client.socket, int(header.decode())))
-                threading.Thread(target=lambda: self.handle_packet(packet, hashed_token)).start()
+                self.handle_packet(packet, hashed_token)
             except socket.error as e:
                 logging.error(f"Socket error: {e}")
                 break
             except Exception as e:
                 logging.error(f"Unexpected error: {e}")
                 break
+        # Check if the session was taken over by a newer connection from the same client.
+        if self.clients.get(hashed_token) is client and client.socket is client_socket:
+            self.disconnect_client(hashed_token)
+
+    async def serve(self) -> None:
+        server = await asyncio.start_server(
+            self.client_stream, socket.gethostname(), SERVER_PORT, ssl=self.ssl_context)
+        logging.info(f"Server started: ('{socket.gethostname()}', {SERVER_PORT}).")
+        async with server:
+            await server.serve_forever()
+
+    async def client_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client_address = writer.get_extra_info("peername")
+        try:
+            # Receive connection token from client and hash it, the token header decides the wire format.
+            wire_format, token = await asyncio.wait_for(read_stream_handshake(reader), HANDSHAKE_TIMEOUT)
+            hashed_token: str = hashlib.sha256(token).hexdigest()
+        except Exception as e:
+            logging.error(f"Failed to receive connection token from {client_address}: {e}")
+            writer.close()
+            return
+        client_socket = StreamSocket(asyncio.get_running_loop(), writer)
+        client: ConnectionToClient = await asyncio.to_thread(
+            self.connect_client, client_socket, client_address, hashed_token, wire_format)
+
+        # Receive data from client and handle each packet in the order it arrived.
+        while True:
+            try:
+                packet: dict = await read_stream_message(reader, wire_format)
+                await asyncio.to_thread(self.handle_packet, packet, hashed_token)
+            except asyncio.IncompleteReadError:
+                break
+            except (ssl.SSLError, OSError) as e:
+                logging.error(f"Socket error: {e}")
+                break
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+                break
+        # Check if the session was taken over by a newer connection from the same client.
+        if self.clients.get(hashed_token) is client and client.socket is client_socket:
+            await asyncio.to_thread(self.disconnect_client, hashed_token)
+
+    def connect_client(
+            self, client_socket, client_address, hashed_token: str, wire_format: WireFormat,
+            client_uuid: str | None = None, username: str = "", guest: bool = True) -> ConnectionToClient:
+        # Expired sessions are dropped first so a client cannot resume one past its TTL.
+        self.disconnected_clients.evict()
+        # A client coming back while its old connection is still half-open takes over the session it had.
+        if hashed_token in self.clients:
+            logging.warning(f"Client {self.clients[hashed_token].uuid} connected again, closing its old connection.")
+            self.disconnect_client(hashed_token)
+        # Check if the client has been previously connected and respond accordingly.
+        if hashed_token in self.disconnected_clients:
+            self.clients[hashed_token] = self.reconnect(
+                client_socket=client_socket, hashed_token=hashed_token, wire_format=wire_format)
+            logging.info(f"Reconnected to client: {self.clients[hashed_token].uuid}, Sending UUID...")
+        else:
+            self.clients[hashed_token] = ConnectionToClient(
+                client_socket, client_address, hashed_token, client_uuid or str(uuid.uuid4()), wire_format)
+            logging.info(f"Connected to client: {self.clients[hashed_token].uuid}, Sending UUID...")
+        client: ConnectionToClient = self.clients[hashed_token]
+        client.last_received = time.monotonic()
+        self.watch_idle(client, self.heartbeat_interval)
+        client.send_packet(DataPacketState.UUID, client.uuid)
+        # Clients moved from another shard bring their name, guest names are only kept in memory.
+        self.user_manager.add_user(client.uuid, hashed_token, username, guest)
+        self.database.insert_user(client.uuid, hashed_token)
+        return client
+
+    def disconnect_client(self, hashed_token: str) -> None:
+        client: ConnectionToClient = self.clients[hashed_token]
         logging.warning(f"Lost connection to client: {client.uuid}")
-        client.socket.close()
+        client.close()
+        if hashed_token in self.idle_timers:
+            self.idle_timers.pop(hashed_token).cancel()
 
         # Move the client instance to the disconnected clients dictionary.
         self.disconnected_clients[hashed_token] = self.clients.pop(hashed_token)
 
+    def watch_idle(self, client: ConnectionToClient, delay: float) -> None:
+        if client.hashed_token in self.idle_timers:
+            self.idle_timers[client.hashed_token].cancel()
+        self.idle_timers[client.hashed_token] = self.scheduler.schedule(delay, self.check_idle, client)
+
+    def check_idle(self, client: ConnectionToClient) -> None:
+        # Packets only update the time they arrived, the check reschedules itself instead of every packet doing so.
+        if self.clients.get(client.hashed_token) is not client:
+            return
+        idle = time.monotonic() - client.last_received
+        if idle >= self.idle_timeout:
+            logging.warning(f"Client {client.uuid} was silent for {idle:.0f} s, disconnecting.")
+            # Closing wakes the thread reading from the client, which then disconnects it as usual.
+            client.close()
+            return
+        if idle >= self.heartbeat_interval:
+            client.send_packet(DataPacketState.HEARTBEAT, "")
+            self.watch_idle(client, self.idle_timeout - idle)
+        else:
+            self.watch_idle(client, self.heartbeat_interval - idle)
+
+    def sweep_disconnected_clients(self) -> None:
+        try:
+            self.disconnected_clients.evict()
+        finally:
+            self.scheduler.schedule(RECONNECT_SWEEP_INTERVAL, self.sweep_disconnected_clients)
+
+    def evict_client(self, client: ConnectionToClient) -> None:
+        # The session expired, so the client can no longer come back to its seat.
+        logging.info(f"Evicted session of client: {client.uuid}")
+        client.close()
+        # A guest cannot come back to an evicted session, so their name is free for someone else.
+        user = self.user_manager.get_user(client.uuid)
+        if user is not None and user["guest"] and user["username"]:
+            self.user_manager.set_username(client.uuid, "")
+        game = self.game_manager.get_game(client.in_game)
+        # Players still seated are not loaded from the database again while the game sends them updates.
+        self.user_manager.remove_user(client.uuid, evicted=game is not None)
+        if game is not None:
+            game.mailbox.post(self.remove_evicted_player, game, client.uuid)
+
+    def remove_evicted_player(self, game: "Game", player_uuid: str) -> None:
+        if player_uuid not in game.players:
+            return
+        if not game.started:
+            game.remove_player(player_uuid)
+            self.user_manager.set_game_code(player_uuid, "")
+        # A started game cannot lose a seat, it is only closed once none of its players can return.
+        elif not any(self.clients.get(self.controller.get_connection_hash(player)) or
+                     self.controller.get_connection_hash(player) in self.disconnected_clients
+                     for player in game.players if player != player_uuid):
+            game.close_game()
+
     def handle_packet(self, packet: dict, hashed_token: str) -> None:
-        client_uuid: str = self.clients[hashed_token].uuid
+        client: ConnectionToClient = self.clients[hashed_token]
+        client_uuid: str = client.uuid
+        client.last_received = time.monotonic()
 
         # Handle request.
         if packet["state"].startswith("RQ"):
-            match packet["state"]:
-                case RequestState.NEW_GAME.value:
-                    logging.info(f"Request from client {client_uuid} to create a new game.")
-                    result = self.controller.request_new_game(hashed_token)
-                case RequestState.GAME_JOIN.value:
-                    logging.info(f"Request from client {client_uuid} to join game {packet["data"]}.")
-                    result = self.controller.request_game_join(hashed_token, packet["data"])
-                case RequestState.GAME_START.value:
-                    logging.info(f"Request from client {client_uuid} to start game.")
-                    result = self.controller.request_game_start(hashed_token, packet["data"])
-                case RequestState.UUID.value:
-                    logging.info(f"Request from client {client_uuid} to obtain UUID.")
-                    result = (ResponseState.UUID, str(client_uuid))
-                case RequestState.GAME_DATA.value:
-                    logging.info(f"Request from client {client_uuid} for game data.")
-                    result = self.controller.request_game_data(hashed_token)
-                case _:
-                    logging.warning("Received invalid request.")
-                    result = ResponseState.INVALID_REQUEST, ""
-            self.clients[hashed_token].respond(result[0], result[1])
-            logging.info(f"Responded to client {client_uuid} with {result[0]}.")
+            # A client's requests are handled one at a time in the order they arrived.
+            with client.requests_received_lock:
+                client.requests_received.append(packet)
+                if len(client.requests_received) > 1:
+                    return
+            self.dispatch_request(client)
 
         # Handle response.
         elif packet["state"].startswith("RS"):
@@ -143,116 +370,587 @@ class Server:
                     logging.warning("Request sent was invalid.")
                 case _:
                     logging.warning("Received invalid response.")
-            self.clients[hashed_token].has_responded = True
+            self.clients[hashed_token].response_received(packet.get("id"))
+
+        # Handle data packet.
+        elif packet["state"] == DataPacketState.HEARTBEAT.value:
+            logging.debug(f"Received heartbeat from client {client_uuid}.")
 
         # Handle invalid packet.
         else:
             logging.warning("Received invalid packet.")
 
-    def reconnect(self, *, client_socket: ssl.SSLSocket, hashed_token: str) -> ConnectionToClient:
+    def dispatch_request(self, client: ConnectionToClient) -> None:
+        packet = client.requests_received[0]
+        # Game requests wait their turn on the game's mailbox, so each table changes on one thread at a time.
+        game = self.get_request_game(packet, client)
+        if game is not None:
+            game.mailbox.post(self.run_request, self.handle_request, packet, client)
+        else:
+            self.executor.submit(self.run_request, self.handle_request, packet, client)
+
+    def run_request(
+            self, handler: typing.Callable[..., bool], packet: dict, client: ConnectionToClient,
+            *args: typing.Any) -> None:
+        # Handlers return False when the request is answered later, from another game's mailbox.
+        answered = True
+        try:
+            answered = handler(packet, client, *args)
+        except Exception as e:
+            logging.error(f"Request {packet["state"]} from client {client.uuid} failed: {e}")
+        if answered:
+            self.finish_request(client)
+
+    def finish_request(self, client: ConnectionToClient) -> None:
+        # The next request of the client only starts once the one before it has been answered.
+        with client.requests_received_lock:
+            client.requests_received.popleft()
+            if not client.requests_received:
+                return
+        self.dispatch_request(client)
+
+    def get_request_game(self, packet: dict, client: ConnectionToClient) -> "Game | None":
+        if packet["state"] not in GAME_REQUESTS:
+            return None
+        if packet["state"] == RequestState.GAME_JOIN.value:
+            return self.game_manager.get_game(packet["data"]) if isinstance(packet["data"], str) else None
+        return self.game_manager.get_game(client.in_game)
+
+    def handle_request(self, packet: dict, client: ConnectionToClient) -> bool:
+        hashed_token: str = client.hashed_token
+        client_uuid: str = client.uuid
+        # Check if the client left while the request was waiting on the mailbox.
+        if self.clients.get(hashed_token) is not client:
+            return True
+        match packet["state"]:
+            case RequestState.NEW_GAME.value:
+                logging.info(f"Request from client {client_uuid} to create a new game.")
+                result = self.controller.request_new_game(hashed_token, packet["data"])
+            case RequestState.GAME_JOIN.value:
+                logging.info(f"Request from client {client_uuid} to join game {packet["data"]}.")
+                result = self.controller.request_game_join(hashed_token, packet["data"])
+            case RequestState.GAME_START.value:
+                logging.info(f"Request from client {client_uuid} to start game.")
+                result = self.controller.request_game_start(hashed_token, packet["data"])
+            case RequestState.UUID.value:
+                logging.info(f"Request from client {client_uuid} to obtain UUID.")
+                result = (ResponseState.UUID, str(client_uuid))
+            case RequestState.GAME_DATA.value:
+                logging.info(f"Request from client {client_uuid} for game data.")
+                result = self.controller.request_game_data(hashed_token)
+            case RequestState.ROUND_START.value:
+                logging.info(f"Request from client {client_uuid} to start round.")
+                result = self.controller.request_round_start(hashed_token)
+            case RequestState.PREDICTION.value:
+                logging.info(f"Request from client {client_uuid} to predict {packet["data"]}.")
+                result = self.controller.request_prediction(hashed_token, packet["data"])
+            case RequestState.PLACE_CARD.value:
+                logging.info(f"Request from client {client_uuid} to place card {packet["data"]}.")
+                result = self.controller.request_card_to_place(hashed_token, packet["data"])
+            case RequestState.FIND_GAME.value:
+                logging.info(f"Request from client {client_uuid} to find a game with {packet["data"]}.")
+                # Answered once a table has been joined or opened, which can take a turn on a game's mailbox.
+                return self.find_game(packet, client)
+            case RequestState.LOBBY_LIST.value:
+                logging.info(f"Request from client {client_uuid} for public lobbies.")
+                # Only the front of a sharded server sets the list, clients cannot send their own.
+                result = self.controller.request_lobby_list(
+                    packet["data"], packet.get("lobby_list") if self.game_manager.shard is not None else None)
+            case RequestState.SET_USERNAME.value:
+                logging.info(f"Request from client {client_uuid} to set username to {packet["data"]}.")
+                result = self.controller.request_set_username(hashed_token, packet["data"])
+            case _:
+                logging.warning("Received invalid request.")
+                result = ResponseState.INVALID_REQUEST, ""
+        client.respond(result[0], result[1], packet.get("id"))
+        logging.info(f"Responded to client {client_uuid} with {result[0]}.")
+        return True
+
+    def find_game(self, packet: dict, client: ConnectionToClient, attempt: int = 0) -> bool:
+        settings = self.controller.get_lobby_settings(packet["data"])
+        if settings is None:
+            client.respond(ResponseState.JOIN_GAME_FAILED, "Invalid settings.", packet.get("id"))
+            return True
+        if attempt == 0 and self.game_manager.shard is not None and packet.get("lobby"):
+            # Sharded servers are sent the lobby found in the index every worker shares.
+            code = packet["lobby"]
+        else:
+            code = self.game_manager.public_lobbies.find(settings) if attempt < MATCHMAKING_ATTEMPTS else None
+        game = self.game_manager.get_game(code) if code is not None else None
+        if game is not None:
+            game.mailbox.post(self.run_request, self.join_found_game, packet, client, game, attempt)
+            return False
+        # No open table has these settings, so the client opens one for the next players to find.
+        result = self.controller.request_new_game(client.hashed_token, {**packet["data"], "public": True})
+        client.respond(result[0], result[1], packet.get("id"))
+        return True
+
+    def join_found_game(self, packet: dict, client: ConnectionToClient, game: "Game", attempt: int) -> bool:
+        # Check if the client left while the join was waiting on the mailbox, the seat held for it is given back.
+        if self.clients.get(client.hashed_token) is not client:
+            game.update_lobby_index()
+            return True
+        result = self.controller.request_game_join(client.hashed_token, game.code)
+        if result[0] == ResponseState.JOIN_GAME_SUCCESS:
+            client.respond(result[0], result[1], packet.get("id"))
+            return True
+        # The seat held for the client was not taken, so the lobby is listed as it really is again.
+        game.update_lobby_index()
+        if result[0] == ResponseState.ALREADY_IN_GAME:
+            client.respond(result[0], result[1], packet.get("id"))
+            return True
+        # The table filled up or started since it was found, so look again.
+        return self.find_game(packet, client, attempt + 1)
+
+    def reconnect(
+            self, *, client_socket: ssl.SSLSocket, hashed_token: str, wire_format: WireFormat) -> ConnectionToClient:
         client: ConnectionToClient = self.disconnected_clients.pop(hashed_token)
         client.socket = client_socket
-        client.has_responded = True
+        client.wire_format = wire_format
+        client.game_data = None
+        client.reset_requests()
+        client.reset_outbound()
         return client
 
 
+async def read_stream_handshake(reader: asyncio.StreamReader) -> tuple[WireFormat, bytes]:
+    first_byte: bytes = await reader.readexactly(1)
+    wire_format = get_wire_format(first_byte)
+    header: bytes = first_byte + await reader.readexactly(get_header_size(wire_format) - 1)
+    return wire_format, await reader.readexactly(parse_header(header, wire_format)[1])
+
+
+async def read_stream_message(reader: asyncio.StreamReader, wire_format: WireFormat) -> dict:
+    # Receive header with size of the rest of the message.
+    header: bytes = await reader.readexactly(get_header_size(wire_format))
+    header_message, length = parse_header(header, wire_format)
+    return decode_message(header_message, await reader.readexactly(length), wire_format)
+
+
+class StreamSocket:
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter) -> None:
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.writer: asyncio.StreamWriter = writer
+
+    def getblocking(self) -> bool:
+        return False
+
+    def sendall(self, data: bytes) -> None:
+        # Writes are handed to the event loop so handlers running in worker threads never block on the socket.
+        self.loop.call_soon_threadsafe(self.write, data)
+
+    def write(self, data: bytes) -> None:
+        # Check if the client has fallen too far behind, its transport is dropped rather than buffering forever.
+        if self.writer.transport.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() + len(data) > MAX_OUTBOUND_BYTES:
+            logging.warning(f"Disconnecting {self.writer.get_extra_info("peername")}, client fell too far behind.")
+            self.writer.transport.abort()
+            return
+        self.writer.write(data)
+
+    def shutdown(self, how: int) -> None:
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class ReconnectionStore:
+    # Disconnected clients by hashed token, sessions expire after the TTL and the oldest go first when full.
+    def __init__(
+            self, on_evict: typing.Callable[[ConnectionToClient], None], ttl: float = RECONNECT_TTL,
+            max_size: int = RECONNECT_MAX_SIZE) -> None:
+        self.on_evict: typing.Callable[[ConnectionToClient], None] = on_evict
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        # Every session gets the same TTL, so insertion order is also expiry order.
+        self.sessions: collections.OrderedDict[str, tuple[float, ConnectionToClient]] = collections.OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+
+    def __setitem__(self, hashed_token: str, client: ConnectionToClient) -> None:
+        with self.lock:
+            self.sessions.pop(hashed_token, None)
+            self.sessions[hashed_token] = (time.monotonic() + self.ttl, client)
+        self.evict()
+
+    def __contains__(self, hashed_token: str) -> bool:
+        return hashed_token in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def get(self, hashed_token: str) -> ConnectionToClient | None:
+        session = self.sessions.get(hashed_token)
+        return session[1] if session else None
+
+    def pop(self, hashed_token: str) -> ConnectionToClient:
+        with self.lock:
+            return self.sessions.pop(hashed_token)[1]
+
+    def evict(self) -> None:
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            while self.sessions:
+                hashed_token, (expiry, client) = next(iter(self.sessions.items()))
+                if expiry > now and len(self.sessions) <= self.max_size:
+                    break
+                self.sessions.popitem(last=False)
+                evicted.append(client)
+        # Clean up outside the lock, eviction can touch games that look up other sessions.
+        for client in evicted:
+            self.on_evict(client)
+
+
+class CodeAllocator:
+    # Hands out every code of the given length once in a shuffled order, then reuses released codes.
+    def __init__(self, length: int = GAME_CODE_LENGTH, shard: tuple[int, int] | None = None) -> None:
+        self.length: int = length
+        self.shard: tuple[int, int] | None = shard
+        self.size: int = len(string.ascii_uppercase) ** length
+        # Indices are permuted by a Feistel network on the smallest even number of bits that covers every code.
+        self.half_bits: int = ((self.size - 1).bit_length() + 1) // 2
+        # Codes are the only thing keeping private tables private, so the order comes from a secret key.
+        self.key: bytes = secrets.token_bytes(16)
+        # Taking the next index and popping a released code are both atomic, so allocating needs no lock.
+        self.indices: typing.Iterator[int] = itertools.count()
+        self.released: collections.deque[str] = collections.deque()
+        # Codes of restored games, the permutation must skip them while they may still be in use.
+        self.reserved: set[str] = set()
+
+    def permute(self, number: int) -> int:
+        left, right = number >> self.half_bits, number & ((1 << self.half_bits) - 1)
+        for round_number in range(CODE_ROUNDS):
+            digest = hashlib.blake2b(
+                right.to_bytes(8, "big") + bytes([round_number]), digest_size=8, key=self.key).digest()
+            left, right = right, left ^ (int.from_bytes(digest, "big") & ((1 << self.half_bits) - 1))
+        return left << self.half_bits | right
+
+    def get_code(self, index: int) -> str:
+        # Numbers past the last code are permuted again until they land on one, which keeps it a permutation.
+        number = self.permute(index)
+        while number >= self.size:
+            number = self.permute(number)
+        letters = []
+        for _ in range(self.length):
+            number, letter = divmod(number, len(string.ascii_uppercase))
+            letters.append(string.ascii_uppercase[letter])
+        return "".join(letters)
+
+    def allocate(self) -> str | None:
+        # Unused codes first, so a closed game's code is not handed straight to the next table.
+        for index in self.indices:
+            if index >= self.size:
+                break
+            code = self.get_code(index)
+            if self.shard is not None and get_shard(code, self.shard[1]) != self.shard[0]:
+                continue
+            if code not in self.reserved:
+                return code
+        try:
+            return self.released.popleft()
+        except IndexError:
+            return None
+
+    def release(self, code: str) -> None:
+        if len(code) == self.length:
+            self.released.append(code)
+
+    def reserve(self, code: str) -> None:
+        self.reserved.add(code)
+
+
+class LobbyIndex:
+    # Public lobbies that still have free seats, bucketed by settings and then by the number of free seats.
+    def __init__(self) -> None:
+        self.buckets: dict[tuple[int, str], list[dict[str, None]]] = {}
+        # Codes kept sorted so lobby lists can be paged with the last code seen as the cursor.
+        self.codes: list[str] = []
+        self.codes_by_settings: dict[tuple[int, str], list[str]] = {}
+        self.entries: dict[str, dict] = {}
+        # Lobbies change on their own mailboxes, so the shared index has its own lock.
+        self.lock: threading.Lock = threading.Lock()
+        # Called with the code and new entry of every lobby that changes, None once it can no longer be joined.
+        self.on_change: typing.Callable[[str, dict | None], None] | None = None
+
+    def update(self, game: "Game") -> None:
+        # Check if the lobby can still be joined by anyone.
+        if not game.public or game.started or len(game.players) >= game.max_players or \
+                game.manager.get_game(game.code) is not game:
+            self.put(game.code, None)
+            return
+        self.put(game.code, {
+            "code": game.code,
+            "players": len(game.players),
+            "max_players": game.max_players,
+            "starting_cards": game.starting_cards,
+            "trump_order": game.trump_order
+        })
+
+    def remove(self, code: str) -> None:
+        self.put(code, None)
+
+    def put(self, code: str, entry: dict | None) -> None:
+        with self.lock:
+            self.remove_entry(code)
+            if entry is not None:
+                self.add_entry(entry)
+            self.changed(code)
+
+    def changed(self, code: str) -> None:
+        # Entries are copied, the index keeps changing its own while the copy is still being sent.
+        if self.on_change is not None:
+            self.on_change(code, dict(self.entries[code]) if code in self.entries else None)
+
+    def add_entry(self, entry: dict) -> None:
+        settings = (entry["starting_cards"], entry["trump_order"])
+        # Lobbies with the same settings have the same number of seats.
+        buckets = self.buckets.setdefault(settings, [{} for _ in range(entry["max_players"] + 1)])
+        buckets[entry["max_players"] - entry["players"]][entry["code"]] = None
+        bisect.insort(self.codes, entry["code"])
+        bisect.insort(self.codes_by_settings.setdefault(settings, []), entry["code"])
+        self.entries[entry["code"]] = entry
+
+    def remove_entry(self, code: str) -> None:
+        entry = self.entries.pop(code, None)
+        if entry is None:
+            return
+        settings = (entry["starting_cards"], entry["trump_order"])
+        self.buckets[settings][entry["max_players"] - entry["players"]].pop(code)
+        for codes in (self.codes, self.codes_by_settings[settings]):
+            codes.pop(bisect.bisect_left(codes, code))
+        if not self.codes_by_settings[settings]:
+            del self.codes_by_settings[settings]
+            del self.buckets[settings]
+
+    def find(self, settings: tuple[int, str], hold: bool = True) -> str | None:
+        # The fullest table goes first so games start sooner, the oldest of them breaks ties.
+        with self.lock:
+            for free_seats, bucket in enumerate(self.buckets.get(settings, [])):
+                if free_seats and bucket:
+                    code = next(iter(bucket))
+                    if not hold:
+                        return code
+                    # The seat is held until the join runs, so clients matched at once are spread over tables.
+                    entry = self.entries[code]
+                    if free_seats == 1:
+                        self.remove_entry(code)
+                    else:
+                        del bucket[code]
+                        self.buckets[settings][free_seats - 1][code] = None
+                        entry["players"] += 1
+                    self.changed(code)
+                    return code
+        return None
+
+    def get_page(self, cursor: str, limit: int, settings: tuple[int, str] | None = None) -> tuple[list[dict], str]:
+        with self.lock:
+            codes = self.codes if settings is None else self.codes_by_settings.get(settings, [])
+            start = bisect.bisect_right(codes, cursor)
+            page = [dict(self.entries[code]) for code in codes[start:start + limit]]
+            # An empty cursor means there are no more pages.
+            return page, page[-1]["code"] if start + limit < len(codes) else ""
+
+    def get_list(self, data: typing.Any) -> dict:
+        if not isinstance(data, dict):
+            data = {}
+        cursor = data.get("cursor") if isinstance(data.get("cursor"), str) else ""
+        limit = data.get("limit") if type(data.get("limit")) is int else LOBBY_PAGE_SIZE
+        # Lobbies are only filtered by settings when the request names some.
+        settings = Controller.get_lobby_settings(data) if "starting_cards" in data or "trump_order" in data else None
+        lobbies, next_cursor = self.get_page(cursor, max(1, min(limit, LOBBY_PAGE_SIZE)), settings)
+        return {"lobbies": lobbies, "cursor": next_cursor}
+
+
 class GameManager:
-    def __init__(self, server: Server) -> None:
+    def __init__(
+            self, server: Server, shard: tuple[int, int] | None = None, code_length: int = GAME_CODE_LENGTH) -> None:
         self.server: Server = server
+        # Index and number of shards when several servers share the code space, each only hands out its own codes.
+        self.shard: tuple[int, int] | None = shard
+        self.code_allocator: CodeAllocator = CodeAllocator(code_length, shard)
+        self.public_lobbies: LobbyIndex = LobbyIndex()
 
         self.lobbies: dict[str, Game] = {}
         self.started: dict[str, Game] = {}
 
-    def generate_game_code(self) -> str:
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase, k=GAME_CODE_LENGTH))
-            if code not in self.lobbies and code not in self.started:
-                logging.info(f"Generated game code: {code}.")
-                return code
+    def get_game(self, code: str) -> "Game | None":
+        return self.lobbies.get(code) or self.started.get(code)
+
+    def generate_game_code(self) -> str | None:
+        code = self.code_allocator.allocate()
+        if code is None:
+            logging.error("Every game code is in use.")
+            return None
+        logging.info(f"Generated game code: {code}.")
+        return code
 
 
 class UserManager:
     def __init__(self, server: Server) -> None:
         self.server: Server = server
-        self.guests: dict[str, dict] = {}
+
+        # Users by uuid, lookups are answered from here and the database is only written to.
+        self.users: dict[str, dict] = {}
+        # Evicted users still in a game, they are not looked up in the database until they leave it.
+        self.evicted: set[str] = set()
+
+    def add_user(self, user_uuid: str, connection_hash: str, username: str = "", guest: bool = True) -> dict:
+        self.evicted.discard(user_uuid)
+        if user_uuid in self.users:
+            self.users[user_uuid]["connection_hash"] = connection_hash
+        else:
+            self.users[user_uuid] = {
+                "connection_hash": connection_hash,
+                "game_code": "",
+                "username": username,
+                "guest": guest
+            }
+        return self.users[user_uuid]
+
+    def remove_user(self, user_uuid: str, evicted: bool = False) -> None:
+        # Dropped from the index only, the database still has the user.
+        self.users.pop(user_uuid, None)
+        if evicted:
+            self.evicted.add(user_uuid)
+
+    def get_user(self, user_uuid: str) -> dict | None:
+        if user_uuid in self.users:
+            return self.users[user_uuid]
+        if user_uuid in self.evicted:
+            return None
+        # Users from before the server started are loaded from the database once.
+        result = self.server.database.get_user(user_uuid)
+        if not result:
+            return None
+        user = self.add_user(user_uuid, result[0] or "", result[2] or "", bool(result[3]))
+        user["game_code"] = result[1] or ""
+        return user
+
+    def set_game_code(self, user_uuid: str, game_code: str) -> None:
+        # Evicted users are no longer indexed but their stored game code still has to be cleared.
+        if user_uuid in self.users:
+            self.users[user_uuid]["game_code"] = game_code
+        elif not game_code:
+            self.evicted.discard(user_uuid)
+        self.server.database.set_game_code(user_uuid, game_code)
+
+    def set_username(self, user_uuid: str, username: str) -> bool:
+        user = self.get_user(user_uuid)
+        if user is None:
+            return False
+        # Names are claimed in the database, so servers sharing it can never give one name to two users.
+        if not self.server.database.claim_username(user_uuid, username, user["guest"]):
+            return False
+        user["username"] = username
+        # Guest names only last while the server runs.
+        if not user["guest"]:
+            self.server.database.set_username(user_uuid, username)
+        return True
 
 
 class Controller:
     def __init__(self, server: Server) -> None:
         self.server: Server = server
         self.database = self.server.database
-        self.database_connection = self.server.database_connection
         self.user_manager = self.server.user_manager
         self.game_manager = self.server.game_manager
 
     def get_user_game_code(self, user_uuid: str) -> str | bool:
-        self.database.execute(f"SELECT game_code FROM Users WHERE uuid = '{user_uuid}'")
-        result = self.database.fetchone()
-        if not result:
+        user = self.user_manager.get_user(user_uuid)
+        if not user:
             logging.info(f"Requested {user_uuid} game code but user does not exist.")
             return False
-        if not result[0]:
+        if not user["game_code"]:
             logging.info(f"Requested {user_uuid} game code but user is not in a game.")
             return False
         logging.info(f"Requested {user_uuid} game code.")
-        return result[0]
+        return user["game_code"]
 
     def get_connection_hash(self, user_uuid: str) -> str | bool:
-        self.database.execute(f"SELECT connection_hash FROM Users WHERE uuid = '{user_uuid}'")
-        result = self.database.fetchone()
-        if not result:
+        user = self.user_manager.get_user(user_uuid)
+        if not user:
             logging.info(f"Requested {user_uuid} connection hash but user does not exist.")
             return False
-        if not result[0]:
+        if not user["connection_hash"]:
             logging.info(f"Requested {user_uuid} connection hash but user is not connected.")
             return False
         logging.info(f"Requested {user_uuid} connection hash.")
-        return result[0]
+        return user["connection_hash"]
 
     def get_username(self, user_uuid: str) -> str:
-        self.database.execute(f"SELECT username, guest FROM Users WHERE uuid = '{user_uuid}'")
-        result = self.database.fetchone()
-        if not result:
+        user = self.user_manager.get_user(user_uuid)
+        if not user:
             logging.info(f"Requested {user_uuid} username but user does not exist.")
             return ""
         logging.info(f"Requested {user_uuid} username.")
-        if result[1]:
-            return f"Guest({result[0]})"
+        if user["guest"]:
+            return f"Guest({user["username"]})"
         else:
-            return result[0]
+            return user["username"]
 
     def set_username(self, user_uuid: str, username: str) -> bool:
-        if user_uuid in self.user_manager.guests:
-            if any(x["username"] == username for x in self.user_manager.guests.values()):
-                logging.info(f"Guest: {user_uuid} requested to set username to {username} but username is taken.")
-                return False
-            else:
-                self.user_manager.guests[user_uuid]["username"] = username
-                logging.info(f"Guest: {user_uuid} set username to {username}.")
-                return True
-        else:
-            self.database.execute("SELECT id FROM Users WHERE username = %s", (username,))
-            if self.database.fetchone():
-                logging.info(f"User: {user_uuid} requested to set username to {username} but username is taken.")
-                return False
-            else:
-                self.database.execute("UPDATE Users SET username = %s WHERE uuid = %s", (username, str(user_uuid)))
-                self.database_connection.commit()
-                logging.info(f"User: {user_uuid} set username to {username}.")
-                return True
+        # Guests and registered users share one index, so the check is the same for both.
+        if not self.user_manager.set_username(user_uuid, username):
+            logging.info(f"User: {user_uuid} requested to set username to {username} but username is taken.")
+            return False
+        logging.info(f"User: {user_uuid} set username to {username}.")
+        # Players already at a table see the new name.
+        game = self.game_manager.get_game(self.get_user_game_code(user_uuid) or "")
+        if game is not None:
+            game.mailbox.post(game.rename_player, user_uuid, self.get_username(user_uuid))
+        return True
+
+    def request_set_username(self, hashed_token: str, username: typing.Any) -> tuple[ResponseState, str]:
+        client_uuid = self.server.clients[hashed_token].uuid
+        # Check if the username is valid.
+        if not isinstance(username, str) or username != username.strip() or \
+                not 0 < len(username) <= USERNAME_MAX_LENGTH or not username.isprintable():
+            logging.info(f"Client: {client_uuid} requested to set username to {username} but it is not valid.")
+            return ResponseState.INVALID_USERNAME, ""
+        if not self.set_username(client_uuid, username):
+            return ResponseState.USERNAME_TAKEN, username
+        return ResponseState.SUCCESS, username
 
     def send_game_update(self, game_code: str) -> None:
         if game_code in self.game_manager.lobbies:
-            for player in self.game_manager.lobbies[game_code].players:
-                self.server.clients[self.get_connection_hash(player)].send_packet(
-                    DataPacketState.GAME_DATA, self.get_game_data_for_player(player))
+            game = self.game_manager.lobbies[game_code]
         elif game_code in self.game_manager.started:
-            for player in self.game_manager.started[game_code].players:
-                self.server.clients[self.get_connection_hash(player)].send_packet(
-                    DataPacketState.GAME_DATA, self.get_game_data_for_player(player))
+            game = self.game_manager.started[game_code]
+        else:
+            return
+        for player in game.players:
+            # Players who are not connected get a full snapshot when they reconnect.
+            client = self.server.clients.get(self.get_connection_hash(player))
+            if client is not None:
+                self.send_game_data(client, game, game.get_data_for_player(player))
         logging.info(f"Sent game update for game {game_code}.")
 
-    def request_new_game(self, hashed_token: str) -> tuple[ResponseState, typing.Any]:
+    def send_game_data(self, client: ConnectionToClient, game: "Game", game_data: dict) -> None:
+        # Send a full snapshot if the client has nothing for this game yet, otherwise only what changed.
+        if client.game_data is None or client.game_data.get("code") != game.code:
+            client.send_encoded(DataPacketState.GAME_DATA, game.get_encoded_data_for_player(client.uuid))
+        else:
+            client.send_encoded(DataPacketState.GAME_PATCH, game.get_encoded_patch(
+                client.game_data, diff_data(client.game_data["private"], game_data["private"], ("private",))))
+        client.game_data = game_data
+
+    @staticmethod
+    def get_lobby_settings(data: typing.Any) -> tuple[int, str] | None:
+        # Settings a lobby is listed and matched with, None if they could never start a game.
+        if not isinstance(data, dict):
+            return None
+        starting_cards = data.get("starting_cards", 0)
+        trump_order = data.get("trump_order", "HCDS-")
+        if type(starting_cards) is not int or not 0 <= starting_cards <= 52 // 2:
+            return None
+        if not isinstance(trump_order, str) or not trump_order or \
+                trump_order != "".join(filter({"H", "C", "D", "S", "-"}.__contains__, trump_order.upper()))[:17]:
+            return None
+        return starting_cards, trump_order
+
+    def request_new_game(self, hashed_token: str, data: typing.Any = "") -> tuple[ResponseState, typing.Any]:
         client_uuid = self.server.clients[hashed_token].uuid
         # Check if client is in a game.
         if self.server.clients[hashed_token].in_game:
@@ -260,13 +958,29 @@ class Controller:
             return ResponseState.ALREADY_IN_GAME, ""
         # Check if client is a guest.
 
+        # Check if the lobby is to be listed publicly with valid settings.
+        public = isinstance(data, dict) and data.get("public") is True
+        settings = self.get_lobby_settings(data) if public else None
+        if public and settings is None:
+            logging.info(f"Client: {client_uuid} requested to create a public game with invalid settings.")
+            return ResponseState.CREATE_GAME_FAILED, "Invalid settings."
+
         code = self.game_manager.generate_game_code()
-        self.game_manager.lobbies[code] = Game(self.game_manager, code)
-        self.game_manager.lobbies[code].add_player(client_uuid)
+        # Check if a game code was free.
+        if code is None:
+            return ResponseState.CREATE_GAME_FAILED, "No game codes are free."
+        game = Game(self.game_manager, code)
+        if public:
+            game.set_lobby_settings(True, *settings)
+        game.add_player(client_uuid)
         self.server.clients[hashed_token].in_game = code
-        self.database.execute(f"UPDATE Users SET game_code = '{code}' WHERE uuid = '{client_uuid}'")
+        self.user_manager.set_game_code(client_uuid, code)
         logging.info(f"Client: {client_uuid} created new game {code}.")
-        return ResponseState.CREATE_GAME_SUCCESS, self.get_game_data_for_player(client_uuid)
+        self.server.clients[hashed_token].game_data = game.get_data_for_player(client_uuid)
+        # The game is only added once it is set up, from then on it only changes on its mailbox.
+        self.game_manager.lobbies[code] = game
+        game.update_lobby_index()
+        return ResponseState.CREATE_GAME_SUCCESS, self.server.clients[hashed_token].game_data
 
     def request_game_join(self, hashed_token: str, code: str) -> tuple[ResponseState, typing.Any]:
         client_uuid = self.server.clients[hashed_token].uuid
@@ -288,10 +1002,17 @@ class Controller:
             return ResponseState.JOIN_GAME_FAILED, f"Game {code} is full."
 
         self.server.clients[hashed_token].in_game = code
-        self.database.execute(f"UPDATE Users SET game_code = '{code}' WHERE uuid = '{client_uuid}'")
+        self.user_manager.set_game_code(client_uuid, code)
         self.game_manager.lobbies[code].add_player(client_uuid)
         logging.info(f"Client: {client_uuid} joined game {code}.")
-        return ResponseState.JOIN_GAME_SUCCESS, self.get_game_data_for_player(client_uuid)
+        self.server.clients[hashed_token].game_data = self.get_game_data_for_player(client_uuid)
+        return ResponseState.JOIN_GAME_SUCCESS, self.server.clients[hashed_token].game_data
+
+    def request_lobby_list(self, data: typing.Any, lobby_list: dict | None = None) -> tuple[ResponseState, typing.Any]:
+        # Sharded servers are sent the list from the index every worker shares.
+        if lobby_list is None:
+            lobby_list = self.game_manager.public_lobbies.get_list(data)
+        return ResponseState.LOBBY_LIST, lobby_list
 
     def request_game_start(self, hashed_token: str, data: dict) -> tuple[ResponseState, str]:
         try:
@@ -319,27 +1040,54 @@ class Controller:
         if len(self.game_manager.lobbies[game_code].players) < 2:
             logging.info(f"Client: {client_uuid} requested to start game but not enough players.")
             return ResponseState.START_GAME_FAILED, "Not enough players to start the game."
-        # Check if data is valid.
-        if not 0 <= starting_cards <= (52 // len(self.game_manager.lobbies[game_code].players)):
+        # Check if data is valid, the game is only moved to started once it is known to be able to start.
+        if self.get_lobby_settings(data) is None:
+            logging.info(f"Client: {client_uuid} requested to start game but invalid settings.")
+            return ResponseState.START_GAME_FAILED, "Invalid settings."
+        if not starting_cards <= (52 // len(self.game_manager.lobbies[game_code].players)):
             logging.info(f"Client: {client_uuid} requested to start game but invalid starting cards.")
             return ResponseState.START_GAME_FAILED, "Invalid starting cards."
-        if trump_order != "".join(filter({"H", "C", "D", "S", "-"}.__contains__, trump_order.upper()))[:17]:
-            logging.info(f"Client: {client_uuid} requested to start game but invalid trump order.")
-            return ResponseState.START_GAME_FAILED, "Invalid trump order."
-
-        self.game_manager.started[game_code] = self.game_manager.lobbies.pop(game_code)
-        threading.Thread(
-            target=lambda: self.game_manager.started[game_code].start_game(starting_cards, trump_order)).start()
+        # Check if a public game starts with the settings it was listed with.
+        lobby = self.game_manager.lobbies[game_code]
+        if lobby.public and (starting_cards, trump_order) != (lobby.starting_cards, lobby.trump_order):
+            logging.info(f"Client: {client_uuid} requested to start public game with different settings.")
+            return ResponseState.START_GAME_FAILED, "Public games start with the settings they were listed with."
+
+        # Added to started before it leaves the lobbies, so its requests never miss its mailbox in between.
+        self.game_manager.started[game_code] = lobby
+        self.game_manager.lobbies.pop(game_code)
+        lobby.start_game(starting_cards, trump_order)
         logging.info(f"Client: {client_uuid} started game {game_code}.")
         return ResponseState.START_GAME_SUCCESS, ""
 
+    def request_round_start(self, hashed_token: str) -> tuple[ResponseState, str]:
+        client_uuid = self.server.clients[hashed_token].uuid
+        # Check if client is in a game.
+        if not self.server.clients[hashed_token].in_game:
+            logging.info(f"Client: {client_uuid} requested to start round but is not in a game.")
+            return ResponseState.NOT_IN_GAME, ""
+        game_code = self.server.clients[hashed_token].in_game
+        # Check if game has started.
+        if game_code not in self.game_manager.started:
+            logging.info(f"Client: {client_uuid} requested to start round but game has not started.")
+            return ResponseState.GAME_NOT_STARTED, ""
+        game = self.game_manager.started[game_code]
+        # Check if the game is waiting for the client to start the round.
+        if game.waiting_for != (client_uuid, GameWaitingState.ROUND_START):
+            logging.info(f"Client: {client_uuid} requested to start round but is not their turn.")
+            return ResponseState.NOT_TURN, ""
+        game.start_round()
+        logging.info(f"Client: {client_uuid} started round {game.round_number} in game {game_code}.")
+        return ResponseState.SUCCESS, ""
+
     def request_game_data(self, hashed_token: str) -> tuple[ResponseState, typing.Any]:
         client_uuid = self.server.clients[hashed_token].uuid
 
         if self.server.clients[hashed_token].in_game:
-            game_data = self.get_game_data_for_player(client_uuid)
+            # A full snapshot also resets the base that later patches are made against.
+            self.server.clients[hashed_token].game_data = self.get_game_data_for_player(client_uuid)
             logging.info(f"Client: {client_uuid} requested game data.")
-            return ResponseState.GAME_DATA, game_data
+            return ResponseState.GAME_DATA, self.server.clients[hashed_token].game_data
         else:
             logging.info(f"Client: {client_uuid} requested game data but is not in a game.")
             return ResponseState.NOT_IN_GAME, ""
@@ -357,20 +1105,17 @@ class Controller:
             return ResponseState.GAME_NOT_STARTED, ""
         game = self.game_manager.started[game_code]
         # Check if it is the client's turn to place a card.
-        if game.waiting_for[0] != client_uuid and \
-                game.waiting_for[1] == GameWaitingState.PLACE_CARD:
+        if game.waiting_for != (client_uuid, GameWaitingState.PLACE_CARD):
             logging.info(f"Client: {client_uuid} requested card {card} to place but is not their turn.")
             return ResponseState.NOT_TURN, ""
         # Check if the card is valid.
-        if not game.is_card_valid(client_uuid, card):
+        card_number = card_from_dict(card)
+        if card_number is None or not game.is_card_valid(client_uuid, card_number):
             logging.info(f"Client: {client_uuid} requested card {card} to place but card is not valid.")
             return ResponseState.INVALID_CARD, ""
         logging.info(f"Client: {client_uuid} requested card {card} to place was valid.")
-        # Place the card.
-        game.pile.append(card)
-        game.private_data[client_uuid][game.round_number]["hand"].remove(game.pile[-1])
-        game.players[client_uuid]["rounds"][game.round_number]["cards_left"] -= 1
-        game.waiting_for = (client_uuid, GameWaitingState.NONE)
+        # Place the card and advance the game.
+        game.place_card(client_uuid, card_number)
         logging.info(f"Game: {game_code} waiting for {game.waiting_for}.")
         return ResponseState.SUCCESS, ""
 
@@ -387,18 +1132,16 @@ class Controller:
             return ResponseState.GAME_NOT_STARTED, ""
         game = self.game_manager.started[game_code]
         # Check if it is the client's turn to predict.
-        if game.waiting_for[0] != client_uuid and \
-                game.waiting_for[1] == GameWaitingState.PREDICTION:
+        if game.waiting_for != (client_uuid, GameWaitingState.PREDICTION):
             logging.info(f"Client: {client_uuid} requested prediction {prediction} but is not their turn.")
             return ResponseState.NOT_TURN, ""
-        # Check if the prediction is valid.
-        if not game.is_prediction_valid(client_uuid, prediction):
+        # Check if the prediction is valid, it now comes straight from the network.
+        if type(prediction) is not int or not game.is_prediction_valid(client_uuid, prediction):
             logging.info(f"Client: {client_uuid} requested prediction {prediction} but prediction is not valid.")
             return ResponseState.INVALID_PREDICTION, ""
         logging.info(f"Client: {client_uuid} requested prediction {prediction} was valid.")
-        # Set the prediction.
-        game.players[client_uuid]["rounds"][game.round_number]["prediction"] = prediction
-        game.waiting_for = (client_uuid, GameWaitingState.NONE)
+        # Set the prediction and advance the game.
+        game.make_prediction(client_uuid, prediction)
         logging.info(f"Game: {game_code} waiting for {game.waiting_for}.")
         return ResponseState.SUCCESS, ""
 
@@ -411,25 +1154,7 @@ class Controller:
         else:
             return {}
         try:
-            game_data: dict[str, typing.Any] = {
-                "host": game.host,
-                "code": game_code,
-                "max_players": game.max_players,
-                "trump_order": game.trump_order,
-                "initial_player_order": game.initial_player_order,
-                "current_player_order": game.current_player_order,
-                "started": game.started,
-                "number_of_rounds": game.number_of_rounds,
-                "round_number": game.round_number,
-                "tricks_available": game.tricks_available,
-                "current_trump": game.current_trump,
-                "waiting_for": (game.waiting_for[0], game.waiting_for[1].value),
-                "pile": game.pile,
-                "players": copy.deepcopy(game.players)
-            }
-            game_data["players"][player_uuid]["rounds"] = game_data["players"][player_uuid]["rounds"] | \
-                                                          game.private_data[player_uuid]
-            return game_data
+            return game.get_data_for_player(player_uuid)
         except Exception as e:
             logging.error(f"Error getting game data for player {player_uuid}: {e}")
 
@@ -445,8 +1170,14 @@ class Game:
         self.max_players: int = 7
         self.starting_cards: int = 0
         self.trump_order: str = "HCDS-"
+        # Public lobbies are listed and matched with the settings above.
+        self.public: bool = False
         self.initial_player_order: list[str] = []
-        self.current_player_order: list[str] = []
+        # Orders are shared rotations of the seats and are replaced, never changed in place.
+        self.current_player_order: tuple[str, ...] = ()
+        # Seat index of every player and the player order starting from each seat, built when the game starts.
+        self.seats: dict[str, int] = {}
+        self.rotations: list[tuple[str, ...]] = []
 
         # --- Game Status --- #
         self.started: bool = False
@@ -456,15 +1187,229 @@ class Game:
         self.current_trick: int = 0
         self.current_trump: str = None
         self.waiting_for: tuple[str, GameWaitingState] = None
-        self.pile: list[dict] = []
+        # Cards placed this trick with the player who placed them.
+        self.pile: list[tuple[int, str]] = []
 
         self.players: dict[str, dict] = {}
         self.private_data: dict[str, dict] = {}
+        self.version: int = 0
+        # Requests, timers and evictions that touch the game are run one at a time through here.
+        self.mailbox: Mailbox = Mailbox(self.server.executor)
+        # The current turn ends at the deadline, the timer checking it is rescheduled when moves push it back.
+        self.turn_deadline: float | None = None
+        self.turn_timer: Timer | None = None
+
+        # --- Cached Views --- #
+        self.public_data: dict | None = None
+        self.private_views: dict[str, dict] = {}
+        self.public_patches: dict[int, list] = {}
+        self.encoded_public_data: tuple[int, bytes] | None = None
+        self.encoded_public_patches: dict[int, bytes] = {}
 
     def send_update(self) -> None:
+        self.version += 1
+        if self.server.game_store is not None and not self.server.restoring and \
+                self.server.game_store.is_snapshot_due(self.code):
+            self.server.game_store.save_snapshot(self.code, self.get_snapshot())
+        self.set_turn_deadline()
         self.server.controller.send_game_update(self.code)
 
+    def set_turn_deadline(self) -> None:
+        if not self.server.turn_timeout or self.server.restoring or not self.started or \
+                self.waiting_for[1] not in TIMED_STATES:
+            self.turn_deadline = None
+            return
+        self.turn_deadline = time.monotonic() + self.server.turn_timeout
+        if self.turn_timer is None:
+            self.turn_timer = self.server.scheduler.schedule(
+                self.server.turn_timeout, self.mailbox.post, self.check_turn)
+
+    def check_turn(self) -> None:
+        self.turn_timer = None
+        if self.turn_deadline is None or self.manager.get_game(self.code) is not self:
+            return
+        remaining = self.turn_deadline - time.monotonic()
+        if remaining > 0:
+            self.turn_timer = self.server.scheduler.schedule(remaining, self.mailbox.post, self.check_turn)
+            return
+        self.play_automatic_move()
+
+    def play_automatic_move(self) -> None:
+        player_uuid, state = self.waiting_for
+        logging.info(f"Player {player_uuid} ran out of time for {state} in game {self.code}, moving for them.")
+        match state:
+            case GameWaitingState.ROUND_START:
+                self.start_round()
+            case GameWaitingState.PREDICTION:
+                # The lowest legal prediction, at most one is ever ruled out.
+                self.make_prediction(player_uuid, next(
+                    prediction for prediction in range(self.tricks_available + 1)
+                    if self.is_prediction_valid(player_uuid, prediction)))
+            case GameWaitingState.PLACE_CARD:
+                # The lowest legal card, so a player who walked away gives as little as possible to the table.
+                hand = self.private_data[player_uuid][self.round_number]["hand"]
+                self.place_card(player_uuid, min(
+                    (card for card in get_hand_cards(hand) if self.is_card_valid(player_uuid, card)),
+                    key=get_card_rank))
+
+    def record(self, kind: str, *args: typing.Any) -> None:
+        # Moves are logged against the version they were made on, so they can be replayed on top of a snapshot.
+        if self.server.game_store is not None and not self.server.restoring:
+            self.server.game_store.log_move(self.code, self.version, kind, args)
+
+    def get_snapshot(self) -> dict:
+        return {
+            "host": self.host,
+            "public": self.public,
+            "max_players": self.max_players,
+            "starting_cards": self.starting_cards,
+            "trump_order": self.trump_order,
+            "initial_player_order": self.initial_player_order,
+            "current_player_order": self.current_player_order,
+            "started": self.started,
+            "number_of_rounds": self.number_of_rounds,
+            "round_number": self.round_number,
+            "tricks_available": self.tricks_available,
+            "current_trick": self.current_trick,
+            "current_trump": self.current_trump,
+            "waiting_for": (self.waiting_for[0], self.waiting_for[1].value) if self.waiting_for else None,
+            "pile": self.pile,
+            "players": self.players,
+            "private_data": self.private_data,
+            "version": self.version
+        }
+
+    def load_snapshot(self, snapshot: dict) -> None:
+        for key in ("host", "max_players", "starting_cards", "trump_order", "initial_player_order",
+                    "current_player_order", "started", "number_of_rounds", "round_number", "tricks_available",
+                    "current_trick", "current_trump", "version"):
+            setattr(self, key, snapshot[key])
+        self.public = snapshot.get("public", False)
+        if self.started:
+            self.set_up_seats()
+            if self.current_player_order:
+                self.current_player_order = self.get_player_order(self.current_player_order[0])
+        if snapshot["waiting_for"]:
+            self.waiting_for = (snapshot["waiting_for"][0], GameWaitingState(snapshot["waiting_for"][1]))
+        self.pile = [(card, player) for card, player in snapshot["pile"]]
+        # JSON turns the round numbers into strings, they are turned back here.
+        self.players = {player_uuid: {**player, "rounds": {int(x): y for x, y in player["rounds"].items()}}
+                        for player_uuid, player in snapshot["players"].items()}
+        self.private_data = {player_uuid: {int(x): y for x, y in rounds.items()}
+                             for player_uuid, rounds in snapshot["private_data"].items()}
+
+    def get_public_data(self) -> dict:
+        # The public view is shared by every player and only rebuilt when the version changes.
+        if self.public_data is not None and self.public_data["version"] == self.version:
+            return self.public_data
+        previous = self.public_data or {"players": {}, "round_number": 0}
+        players = {}
+        for player_uuid, player in self.players.items():
+            previous_rounds = previous["players"].get(player_uuid, {}).get("rounds", {})
+            players[player_uuid] = {
+                "rounds": {
+                    # Rounds that had already finished last time cannot change, so their copies are reused.
+                    round_number: previous_rounds[round_number]
+                    if round_number < previous["round_number"] and round_number in previous_rounds
+                    else dict(round_data)
+                    for round_number, round_data in player["rounds"].items()
+                },
+                "username": player["username"],
+                "total_score": player["total_score"],
+            }
+        self.public_data = {
+            "host": self.host,
+            "code": self.code,
+            "max_players": self.max_players,
+            "trump_order": self.trump_order,
+            "initial_player_order": list(self.initial_player_order),
+            "current_player_order": self.current_player_order,
+            "started": self.started,
+            "number_of_rounds": self.number_of_rounds,
+            "round_number": self.round_number,
+            "tricks_available": self.tricks_available,
+            "current_trump": self.current_trump,
+            "waiting_for": (self.waiting_for[0], self.waiting_for[1].value),
+            "pile": [{**card_to_dict(card), "player": player} for card, player in self.pile],
+            "players": players,
+            "version": self.version
+        }
+        self.public_patches = {}
+        self.encoded_public_patches = {}
+        return self.public_data
+
+    def get_private_data(self, player_uuid: str) -> dict:
+        view = self.private_views.get(player_uuid)
+        if view is not None and view["version"] == self.version:
+            return view["data"]
+        previous = view or {"data": {}, "hands": {}}
+        self.private_views[player_uuid] = {
+            "version": self.version,
+            "hands": {round_number: (hands["initial_hand"], hands["hand"])
+                      for round_number, hands in self.private_data[player_uuid].items()},
+            "data": {
+                # Rounds whose hands are the same bitmasks as last time are reused.
+                round_number: previous["data"][round_number]
+                if previous["hands"].get(round_number) == (hands["initial_hand"], hands["hand"])
+                else {"initial_hand": self.get_hand_data(player_uuid, hands["initial_hand"]),
+                      "hand": self.get_hand_data(player_uuid, hands["hand"])}
+                for round_number, hands in self.private_data[player_uuid].items()
+            }
+        }
+        return self.private_views[player_uuid]["data"]
+
+    @staticmethod
+    def get_hand_data(player_uuid: str, hand: int) -> list[dict]:
+        return [{**card_to_dict(card), "player": player_uuid} for card in get_hand_cards(hand)]
+
+    def get_data_for_player(self, player_uuid: str) -> dict:
+        # Only the small private section is built per player, the rest is the shared public view.
+        game_data = dict(self.get_public_data())
+        game_data["private"] = self.get_private_data(player_uuid)
+        return game_data
+
+    def get_public_patch(self, base_data: dict) -> list[list]:
+        # Clients at the same base version need the same public operations, so they are only worked out once.
+        public_data = self.get_public_data()
+        if base_data["version"] not in self.public_patches:
+            self.public_patches[base_data["version"]] = diff_data(
+                {key: value for key, value in base_data.items() if key != "private"}, public_data)
+        return self.public_patches[base_data["version"]]
+
+    def get_encoded_public_data(self) -> bytes:
+        if self.encoded_public_data is None or self.encoded_public_data[0] != self.version:
+            self.encoded_public_data = (self.version, encode_data(self.get_public_data()))
+        return self.encoded_public_data[1]
+
+    def get_encoded_data_for_player(self, player_uuid: str) -> bytes:
+        # The public view is encoded once per version and each player's private section is spliced into it.
+        return (self.get_encoded_public_data()[:-1] + b',"private":'
+                + encode_data(self.get_private_data(player_uuid)) + b"}")
+
+    def get_encoded_patch(self, base_data: dict, private_operations: list[list]) -> bytes:
+        # The public operations are encoded once per base version, without the brackets so they can be joined.
+        public_patch = self.get_public_patch(base_data)
+        if base_data["version"] not in self.encoded_public_patches:
+            self.encoded_public_patches[base_data["version"]] = encode_data(public_patch)[1:-1]
+        operations = [self.encoded_public_patches[base_data["version"]], encode_data(private_operations)[1:-1]]
+        return b'{"base":%d,"ops":[%b]}' % (base_data["version"], b",".join(x for x in operations if x))
+
+    def set_lobby_settings(self, public: bool, starting_cards: int, trump_order: str) -> None:
+        self.record("set_lobby_settings", public, starting_cards, trump_order)
+        self.public = public
+        self.starting_cards = starting_cards
+        self.trump_order = trump_order
+        # A table only has as many seats as there are cards to deal everyone the starting hand.
+        if starting_cards:
+            self.max_players = min(self.max_players, 52 // starting_cards)
+
+    def update_lobby_index(self) -> None:
+        # Restored games are indexed once they are back in the manager.
+        if self.public and not self.server.restoring:
+            self.manager.public_lobbies.update(self)
+
     def add_player(self, player_uuid: str) -> None:
+        self.record("add_player", player_uuid)
         username = self.server.controller.get_username(player_uuid)
 
         self.players[player_uuid] = {
@@ -475,7 +1420,7 @@ class Game:
             "total_score": 0,
         }
         self.private_data[player_uuid] = {
-            # 0: {"initial_hand": [], "hand": []}
+            # 0: {"initial_hand": 0, "hand": 0}
         }
         self.initial_player_order.append(player_uuid)
 
@@ -483,15 +1428,24 @@ class Game:
             self.host = player_uuid
             self.waiting_for = (player_uuid, GameWaitingState.MIN_PLAYERS)
         else:
+            self.waiting_for = (self.host, GameWaitingState.GAME_START)
             self.send_update()
+        self.update_lobby_index()
 
-        if not len(self.players) < 2:
-            self.waiting_for = (self.host, GameWaitingState.GAME_START)
+    def rename_player(self, player_uuid: str, username: str) -> None:
+        if player_uuid not in self.players:
+            return
+        self.record("rename_player", player_uuid, username)
+        self.players[player_uuid]["username"] = username
+        self.send_update()
 
     def remove_player(self, player_uuid: str) -> None:
+        self.record("remove_player", player_uuid)
         self.players.pop(player_uuid)
+        self.private_data.pop(player_uuid, None)
         self.initial_player_order.remove(player_uuid)
-        self.current_player_order.remove(player_uuid)
+        if player_uuid in self.current_player_order:
+            self.current_player_order = tuple(x for x in self.current_player_order if x != player_uuid)
 
         if len(self.players) == 0:
             self.close_game()
@@ -499,7 +1453,14 @@ class Game:
 
         if self.host == player_uuid:
             self.host = self.initial_player_order[0]
+        # Check if the lobby still has enough players to start.
+        if not self.started:
+            if len(self.players) == 1:
+                self.waiting_for = (self.host, GameWaitingState.MIN_PLAYERS)
+            else:
+                self.waiting_for = (self.host, GameWaitingState.GAME_START)
 
+        self.update_lobby_index()
         self.send_update()
 
     def start_game(self, starting_cards: int, trump_order: str) -> None:
@@ -507,20 +1468,28 @@ class Game:
             return
         if len(self.players) < 2:
             return
+        self.set_up_game(starting_cards, trump_order)
+        self.start_round()
+
+    def set_up_game(self, starting_cards: int, trump_order: str) -> None:
+        self.record("set_up_game", starting_cards, trump_order)
         self.starting_cards = starting_cards
         self.trump_order = trump_order
         self.started = True
+        self.set_up_seats()
+        self.update_lobby_index()
         self.waiting_for = (self.host, GameWaitingState.NONE)
         if self.starting_cards == 0:
             self.number_of_rounds = 52 // len(self.players)
         else:
             self.number_of_rounds = self.starting_cards
-        self.start_round()
 
-    def start_round(self) -> None:
+    def start_round(self, hands: dict[str, int] | None = None) -> None:
         self.tricks_available = self.number_of_rounds - self.round_number
+        self.current_trick = 0
         self.current_trump = self.get_current_trump()
         self.current_player_order = self.get_round_player_order()
+        self.pile = []
         for player in self.current_player_order:
             self.players[player]["rounds"][self.round_number] = {
                 "prediction": 0,
@@ -528,15 +1497,54 @@ class Game:
                 "tricks_won": 0,
                 "score": 0
             }
-        self.deal_cards()
-        self.get_predictions()
-        winner = self.current_player_order[0]
-        while self.current_trick < self.tricks_available:
-            self.current_trick += 1
-            self.current_player_order = self.get_player_order(winner)
-            winner = self.start_trick()
-            self.private_data[winner][self.round_number]["tricks_won"] += 1
+        self.deal_cards(hands)
+        # The dealt hands are logged because replaying the move cannot deal the same cards again.
+        self.record("start_round", {player: self.private_data[player][self.round_number]["hand"]
+                                    for player in self.current_player_order})
+        # Wait for the first player to make their prediction.
+        self.waiting_for = (self.current_player_order[0], GameWaitingState.PREDICTION)
+        self.send_update()
+
+    def make_prediction(self, player_uuid: str, prediction: int) -> None:
+        self.record("make_prediction", player_uuid, prediction)
+        self.players[player_uuid]["rounds"][self.round_number]["prediction"] = prediction
+        position = self.current_player_order.index(player_uuid)
+        # Wait for the next player to predict or start the first trick once everyone has.
+        if position + 1 < len(self.current_player_order):
+            self.waiting_for = (self.current_player_order[position + 1], GameWaitingState.PREDICTION)
             self.send_update()
+        else:
+            self.start_trick(self.current_player_order[0])
+
+    def start_trick(self, first_player: str) -> None:
+        self.current_trick += 1
+        self.current_player_order = self.get_player_order(first_player)
+        self.pile = []
+        self.waiting_for = (first_player, GameWaitingState.PLACE_CARD)
+        self.send_update()
+
+    def place_card(self, player_uuid: str, card: int) -> None:
+        self.record("place_card", player_uuid, card)
+        self.private_data[player_uuid][self.round_number]["hand"] &= ~(1 << card)
+        self.pile.append((card, player_uuid))
+        self.players[player_uuid]["rounds"][self.round_number]["cards_left"] -= 1
+        position = self.current_player_order.index(player_uuid)
+        # Wait for the next player to place a card or finish the trick once everyone has.
+        if position + 1 < len(self.current_player_order):
+            self.waiting_for = (self.current_player_order[position + 1], GameWaitingState.PLACE_CARD)
+            self.send_update()
+        else:
+            self.finish_trick()
+
+    def finish_trick(self) -> None:
+        winner = self.get_winning_card()[1]
+        self.players[winner]["rounds"][self.round_number]["tricks_won"] += 1
+        if self.current_trick < self.tricks_available:
+            self.start_trick(winner)
+        else:
+            self.finish_round()
+
+    def finish_round(self) -> None:
         # Calculate scores.
         for player in self.players:
             if self.players[player]["rounds"][self.round_number]["tricks_won"] == \
@@ -545,6 +1553,7 @@ class Game:
                     self.players[player]["rounds"][self.round_number]["tricks_won"] + 10
                 self.players[player]["total_score"] += self.players[player]["rounds"][self.round_number]["score"]
         self.round_number += 1
+        self.pile = []
         # End round.
         if self.round_number == self.number_of_rounds:
             self.waiting_for = (self.host, GameWaitingState.GAME_END)
@@ -552,65 +1561,49 @@ class Game:
             self.waiting_for = (self.host, GameWaitingState.ROUND_START)
         self.send_update()
 
-    def start_trick(self) -> str:
-        self.pile = []
-        self.get_cards_to_place()
-        return self.get_winning_card()["player"]
-
-    def get_round_player_order(self):
-        return self.get_player_order(self.initial_player_order[self.round_number % len(self.players)])
-
-    def get_player_order(self, first_player: str):
-        order = copy.deepcopy(self.initial_player_order)
-        while True:
-            if order[0] == first_player:
-                break
-            order.append(order.pop(0))
-        return order
-
-    def deal_cards(self):
-        deck = random.sample(FULL_DECK, self.tricks_available * len(self.players))
+    def set_up_seats(self) -> None:
+        # Players cannot join or leave once the game has started, so every rotation is built once.
+        self.seats = {player: seat for seat, player in enumerate(self.initial_player_order)}
+        self.rotations = [tuple(self.initial_player_order[seat:] + self.initial_player_order[:seat])
+                          for seat in range(len(self.initial_player_order))]
+
+    def get_round_player_order(self) -> tuple[str, ...]:
+        return self.rotations[self.round_number % len(self.rotations)]
+
+    def get_player_order(self, first_player: str) -> tuple[str, ...]:
+        return self.rotations[self.seats[first_player]]
+
+    def deal_cards(self, hands: dict[str, int] | None = None):
+        # Replayed rounds are given the hands that were dealt originally.
+        if hands is None:
+            deck = random.sample(range(DECK_SIZE), self.tricks_available * len(self.players))
+            hands = {}
+            for i, player in enumerate(self.current_player_order):
+                # Cards are dealt round the table, so every player takes every nth card of the shuffled deck.
+                hands[player] = 0
+                for card in deck[i::len(self.current_player_order)]:
+                    hands[player] |= 1 << card
         for player in self.current_player_order:
             self.private_data[player][self.round_number] = {
-                "initial_hand": [],
-                "hand": []
+                "initial_hand": hands[player],
+                "hand": hands[player]
             }
-        for _ in range(self.tricks_available):
-            for player in self.current_player_order:
-                card = deck.pop()
-                card["player"] = player
-                self.private_data[player][self.round_number]["hand"].append(card)
-                self.private_data[player][self.round_number]["initial_hand"].append(card)
-
-    def get_predictions(self) -> None:
-        for player in self.current_player_order:
-            self.waiting_for = (player, GameWaitingState.PREDICTION)
-            self.send_update()
-            while self.waiting_for[0] == player:
-                pass
-        self.waiting_for = (self.host, GameWaitingState.NONE)
-
-    def get_cards_to_place(self) -> None:
-        for player in self.current_player_order:
-            self.waiting_for = (player, GameWaitingState.PLACE_CARD)
-            self.send_update()
-            while self.waiting_for[0] == player:
-                pass
-        self.waiting_for = (self.host, GameWaitingState.NONE)
 
     def get_current_trump(self):
         return self.trump_order[self.round_number % len(self.trump_order)]
 
-    def is_card_valid(self, player_uuid: str, card: dict) -> bool:
+    def is_card_valid(self, player_uuid: str, card: int) -> bool:
+        hand = self.private_data[player_uuid][self.round_number]["hand"]
         # Check if card is in player's hand.
-        if card not in self.private_data[player_uuid][self.round_number]["hand"]:
+        if not hand >> card & 1:
             return False
         # Check if the card is the first placed.
         if not self.pile:
             return True
         # Check player has a card of the same suit.
-        if any(x["suit"] == self.pile[0]["suit"] for x in self.private_data[player_uuid][self.round_number]["hand"]):
-            return card["suit"] == self.pile[0]["suit"]
+        led_suit = SUIT_MASKS[get_card_suit(self.pile[0][0])]
+        if hand & led_suit:
+            return bool(led_suit >> card & 1)
         return True
 
     def is_prediction_valid(self, player_uuid: str, prediction: int) -> bool:
@@ -619,25 +1612,36 @@ class Game:
         # Check if player is last.
         if player_uuid == self.current_player_order[-1]:
             if prediction == self.tricks_available - sum(
-                    x[self.round_number]["prediction"] for x in self.players.values()):
+                    x["rounds"][self.round_number]["prediction"] for x in self.players.values()):
                 return False
         return True
 
-    def get_winning_card(self) -> dict:
-        def sort_key(card: dict):
-            return (
-                (card["suit"] == self.current_trump),
-                (card["suit"] == self.pile[0][1]),
-                card["value"]
-            )
-
-        winning_card = sorted(self.pile, key=sort_key)[-1]
+    def get_winning_card(self) -> tuple[int, str]:
+        trump_suit = SUITS.index(self.current_trump) if self.current_trump in SUITS else -1
+        winning_card = self.pile[get_trick_winner([card for card, _ in self.pile], trump_suit)]
         logging.info(f"{winning_card} won from {self.pile} in game {self.code}.")
         return winning_card
 
-    def close_game(self):
-        raise NotImplementedError
+    def close_game(self) -> None:
+        self.turn_deadline = None
+        self.manager.public_lobbies.remove(self.code)
+        # Check if the game was still open, its code can only be released once.
+        if self.manager.lobbies.pop(self.code, None) is not self and \
+                self.manager.started.pop(self.code, None) is not self:
+            return
+        self.manager.code_allocator.release(self.code)
+        if self.server.game_store is not None and not self.server.restoring:
+            self.server.game_store.remove_game(self.code)
+        # Players left at the table are free to create or join another game.
+        for player_uuid in self.players:
+            hashed_token = self.server.controller.get_connection_hash(player_uuid)
+            client = self.server.clients.get(hashed_token) or self.server.disconnected_clients.get(hashed_token)
+            if client is not None and client.in_game == self.code:
+                client.in_game = ""
+                client.game_data = None
+            self.server.user_manager.set_game_code(player_uuid, "")
+        logging.info(f"Closed game {self.code}.")
 
 
 if __name__ == "__main__":
-    Server()
+    Server(snapshot_directory="snapshots").run(asynchronous="--async" in sys.argv)
@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import socket
+import ssl
+import threading
+import typing
+import uuid
+
+from main import ConnectionToClient, SERVER_PORT, HANDSHAKE_TIMEOUT, RequestState, ResponseState, WireFormat, \
+    get_shard
+from database import Database
+from server import Controller, LobbyIndex, Server, StreamSocket, read_stream_handshake, read_stream_message
+
+PARENT_CHECK_INTERVAL = 1.0
+
+# Messages between the front process and the workers are tuples of (kind, hashed token, payload).
+# Front to worker: connect, packet, disconnect, transfer, stop.
+# Worker to front: data, close, transfer, evict, lobby, each prefixed with the worker index.
+
+
+class ProxySocket:
+    # Stands in for a client socket inside a worker, outbound bytes are handed to the front process.
+    def __init__(
+            self, outbox: multiprocessing.Queue, worker_index: int, hashed_token: str, connection_id: int) -> None:
+        self.outbox: multiprocessing.Queue = outbox
+        self.worker_index: int = worker_index
+        self.hashed_token: str = hashed_token
+        # Which front connection of the client this stands in for, so closing an old one never closes a newer one.
+        self.connection_id: int = connection_id
+
+    def getblocking(self) -> bool:
+        # Queue puts never block, so the connection does not need its own writer thread.
+        return False
+
+    def sendall(self, data: bytes) -> None:
+        self.outbox.put((self.worker_index, "data", self.hashed_token, data))
+
+    def shutdown(self, how: int) -> None:
+        self.outbox.put((self.worker_index, "close", self.hashed_token, self.connection_id))
+
+    def close(self) -> None:
+        pass
+
+
+class Worker:
+    def __init__(
+            self, worker_index: int, number_of_workers: int, inbox: multiprocessing.Queue,
+            outbox: multiprocessing.Queue, database_path: str) -> None:
+        self.index: int = worker_index
+        self.inbox: multiprocessing.Queue = inbox
+        self.outbox: multiprocessing.Queue = outbox
+        # A socketless server, it only hands out game codes that belong to this worker.
+        self.server: Server = Server(database_path=database_path, shard=(worker_index, number_of_workers))
+        self.server.disconnected_clients.on_evict = self.evict_client
+        self.server.game_manager.public_lobbies.on_change = self.send_lobby
+
+    def run(self) -> None:
+        try:
+            while True:
+                try:
+                    kind, hashed_token, payload = self.inbox.get(timeout=PARENT_CHECK_INTERVAL)
+                except queue.Empty:
+                    # Stop once the front process is gone, nothing else can reach this worker.
+                    if not multiprocessing.parent_process().is_alive():
+                        return
+                    continue
+                if kind == "stop":
+                    return
+                self.handle_message(kind, hashed_token, payload)
+        finally:
+            self.server.scheduler.close()
+            self.server.executor.shutdown(wait=True)
+            self.server.database.close()
+
+    def handle_message(self, kind: str, hashed_token: str, payload: typing.Any) -> None:
+        match kind:
+            case "connect":
+                address, wire_format, client_uuid, connection_id, username, guest = payload
+                self.server.connect_client(
+                    ProxySocket(self.outbox, self.index, hashed_token, connection_id), address, hashed_token,
+                    WireFormat(wire_format), client_uuid, username, guest)
+            case "packet":
+                # Packets can still arrive for a client that has just moved to another worker.
+                if hashed_token in self.server.clients:
+                    self.server.handle_packet(payload, hashed_token)
+            case "disconnect":
+                if hashed_token in self.server.clients:
+                    self.server.disconnect_client(hashed_token)
+            case "transfer":
+                self.transfer_client(hashed_token, payload)
+            case _:
+                logging.warning(f"Worker {self.index} received unknown message {kind}.")
+
+    def transfer_client(self, hashed_token: str, packet: dict) -> None:
+        # The client asked to join a game on another worker, it may only leave if it is not in a game here.
+        client = self.server.clients.get(hashed_token)
+        if client is None:
+            return
+        if client.in_game:
+            client.respond(ResponseState.ALREADY_IN_GAME, "", packet.get("id"))
+            self.outbox.put((self.index, "transfer", hashed_token, (None, "", True)))
+            return
+        # The front connection stays open, the client is only forgotten by this worker.
+        self.server.clients.pop(hashed_token)
+        if hashed_token in self.server.idle_timers:
+            self.server.idle_timers.pop(hashed_token).cancel()
+        # The name goes with the client, the next worker cannot load a guest's name from the database.
+        user = self.server.user_manager.get_user(client.uuid)
+        self.server.user_manager.remove_user(client.uuid)
+        self.outbox.put((self.index, "transfer", hashed_token, (packet, user["username"], user["guest"])))
+
+    def evict_client(self, client: ConnectionToClient) -> None:
+        self.server.evict_client(client)
+        # The session can no longer be resumed, so the front can forget where it was kept.
+        self.outbox.put((self.index, "evict", client.hashed_token, None))
+
+    def send_lobby(self, code: str, entry: dict | None) -> None:
+        # The front keeps the public lobbies of every worker, so matchmaking and the lobby list see all of them.
+        self.outbox.put((self.index, "lobby", code, entry))
+
+
+def run_worker(
+        worker_index: int, number_of_workers: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue,
+        database_path: str) -> None:
+    logging.getLogger().setLevel(logging.WARNING)
+    Worker(worker_index, number_of_workers, inbox, outbox, database_path).run()
+
+
+def get_join_code(packet: dict) -> str | None:
+    # The code of the game a packet joins, if it joins one.
+    if packet["state"] == RequestState.GAME_JOIN.value and isinstance(packet["data"], str):
+        return packet["data"]
+    if packet["state"] == RequestState.FIND_GAME.value:
+        return packet.get("lobby")
+    return None
+
+
+class FrontServer:
+    def __init__(
+            self, number_of_workers: int, database_path: str = "BlobDB.db",
+            certfile: str = r"resources\ssl-tls\fullchain.pem", keyfile: str = r"resources\ssl-tls\privkey.pem"):
+        self.number_of_workers: int = number_of_workers
+        self.database_path: str = database_path
+        self.certfile: str = certfile
+        self.keyfile: str = keyfile
+
+        self.inboxes: list[multiprocessing.Queue] = []
+        self.outbox: multiprocessing.Queue = multiprocessing.Queue()
+        self.processes: list[multiprocessing.Process] = []
+        self.loop: asyncio.AbstractEventLoop = ...
+
+        # Every connected client, the worker it is attached to and the UUID it keeps on every worker.
+        self.sockets: dict[str, StreamSocket] = {}
+        self.wire_formats: dict[str, WireFormat] = {}
+        self.workers: dict[str, int] = {}
+        self.uuids: dict[str, str] = {}
+        # Each stream of a client is numbered, workers close streams by number.
+        self.connection_ids: dict[str, int] = {}
+        self.next_connection_ids: typing.Iterator[int] = itertools.count()
+        # Packets held back while a client moves between workers.
+        self.transferring: dict[str, list[dict]] = {}
+        # The public lobbies of all workers, kept up to date by the workers that own them.
+        self.lobbies: LobbyIndex = LobbyIndex()
+
+    def run(self) -> None:
+        # Guest names from an earlier run are freed before any worker can hand out new ones.
+        database = Database(self.database_path)
+        database.clear_guest_usernames()
+        database.close()
+        for worker_index in range(self.number_of_workers):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_worker, daemon=True,
+                args=(worker_index, self.number_of_workers, inbox, self.outbox, self.database_path))
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        try:
+            asyncio.run(self.serve())
+        finally:
+            for inbox in self.inboxes:
+                inbox.put(("stop", "", None))
+            for process in self.processes:
+                process.join(5)
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.loop_outbox, daemon=True).start()
+
+        ssl_context: ssl.SSLContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+        server = await asyncio.start_server(self.client_stream, socket.gethostname(), SERVER_PORT, ssl=ssl_context)
+        logging.info(f"Front server started with {self.number_of_workers} workers: "
+                     f"('{socket.gethostname()}', {SERVER_PORT}).")
+        async with server:
+            await server.serve_forever()
+
+    def loop_outbox(self) -> None:
+        # Worker messages are read on a thread and handled on the event loop, which owns the client streams.
+        while True:
+            message = self.outbox.get()
+            self.loop.call_soon_threadsafe(self.handle_worker_message, *message)
+
+    def send_to_worker(self, worker_index: int, kind: str, hashed_token: str, payload: typing.Any) -> None:
+        self.inboxes[worker_index].put((kind, hashed_token, payload))
+
+    def handle_worker_message(self, worker_index: int, kind: str, hashed_token: str, payload: typing.Any) -> None:
+        match kind:
+            case "data":
+                if hashed_token in self.sockets:
+                    self.sockets[hashed_token].write(payload)
+            case "close":
+                if hashed_token in self.sockets and self.workers.get(hashed_token) == worker_index and \
+                        self.connection_ids.get(hashed_token) == payload:
+                    self.sockets[hashed_token].writer.transport.abort()
+            case "transfer":
+                self.finish_transfer(worker_index, hashed_token, *payload)
+            case "evict":
+                # A client that has connected again since keeps its worker and UUID.
+                if hashed_token not in self.sockets and self.workers.get(hashed_token) == worker_index:
+                    self.workers.pop(hashed_token)
+                    self.uuids.pop(hashed_token, None)
+            case "lobby":
+                self.lobbies.put(hashed_token, payload)
+
+    def finish_transfer(
+            self, worker_index: int, hashed_token: str, packet: dict | None, username: str, guest: bool) -> None:
+        held_packets = self.transferring.pop(hashed_token, [])
+        if hashed_token not in self.sockets:
+            return
+        if packet is not None:
+            # Attach the client to the worker that owns the game and replay the join there.
+            worker_index = get_shard(get_join_code(packet), self.number_of_workers)
+            self.workers[hashed_token] = worker_index
+            self.send_to_worker(worker_index, "connect", hashed_token, (
+                self.sockets[hashed_token].writer.get_extra_info("peername"),
+                self.wire_formats[hashed_token].value, self.uuids[hashed_token], self.connection_ids[hashed_token],
+                username, guest))
+            # The join was already routed, routing it again could find another lobby and move the client again.
+            self.send_to_worker(worker_index, "packet", hashed_token, packet)
+        for held_packet in held_packets:
+            self.route_packet(hashed_token, held_packet)
+
+    def route_packet(self, hashed_token: str, packet: dict) -> None:
+        if hashed_token in self.transferring:
+            self.transferring[hashed_token].append(packet)
+            return
+        worker_index = self.workers[hashed_token]
+        # Workers only know their own lobbies, so these are answered from the index of all of them.
+        if packet["state"] == RequestState.FIND_GAME.value:
+            settings = Controller.get_lobby_settings(packet["data"])
+            packet["lobby"] = self.lobbies.find(settings, hold=False) if settings is not None else None
+        elif packet["state"] == RequestState.LOBBY_LIST.value:
+            packet["lobby_list"] = self.lobbies.get_list(packet["data"])
+        # Joining a game owned by another worker moves the client there first.
+        code = get_join_code(packet)
+        if code is not None and get_shard(code, self.number_of_workers) != worker_index:
+            self.transferring[hashed_token] = []
+            self.send_to_worker(worker_index, "transfer", hashed_token, packet)
+            return
+        self.send_to_worker(worker_index, "packet", hashed_token, packet)
+
+    async def client_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client_address = writer.get_extra_info("peername")
+        try:
+            wire_format, token = await asyncio.wait_for(read_stream_handshake(reader), HANDSHAKE_TIMEOUT)
+            hashed_token: str = hashlib.sha256(token).hexdigest()
+        except Exception as e:
+            logging.error(f"Failed to receive connection token from {client_address}: {e}")
+            writer.close()
+            return
+        client_socket = StreamSocket(self.loop, writer)
+        # A client coming back while its old stream is still half-open replaces it, the worker keeps the session.
+        if hashed_token in self.sockets:
+            self.sockets[hashed_token].writer.transport.abort()
+        self.sockets[hashed_token] = client_socket
+        self.wire_formats[hashed_token] = wire_format
+        connection_id = self.connection_ids[hashed_token] = next(self.next_connection_ids)
+
+        # Returning clients go back to the worker that kept their session, new ones are spread by token.
+        worker_index = self.workers.setdefault(hashed_token, get_shard(hashed_token, self.number_of_workers))
+        client_uuid = self.uuids.setdefault(hashed_token, str(uuid.uuid4()))
+        self.send_to_worker(
+            worker_index, "connect", hashed_token,
+            (client_address, wire_format.value, client_uuid, connection_id, "", True))
+
+        while True:
+            try:
+                self.route_packet(hashed_token, await read_stream_message(reader, wire_format))
+            except asyncio.IncompleteReadError:
+                break
+            except (ssl.SSLError, OSError) as e:
+                logging.error(f"Socket error: {e}")
+                break
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+                break
+        if self.sockets.get(hashed_token) is client_socket:
+            self.sockets.pop(hashed_token)
+            self.wire_formats.pop(hashed_token)
+            self.connection_ids.pop(hashed_token)
+            self.send_to_worker(self.workers[hashed_token], "disconnect", hashed_token, None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the server as a front process and game worker processes.")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--database", default="BlobDB.db")
+    parser.add_argument("--certfile", default=r"resources\ssl-tls\fullchain.pem")
+    parser.add_argument("--keyfile", default=r"resources\ssl-tls\privkey.pem")
+    arguments = parser.parse_args()
+    FrontServer(arguments.workers, arguments.database, arguments.certfile, arguments.keyfile).run()
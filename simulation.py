@@ -0,0 +1,188 @@
+import argparse
+import gc
+import logging
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+
+from benchmark import create_table
+from main import GameWaitingState, ResponseState, WireFormat, VALUES
+from server import Server, Game
+
+TRUMP_ORDERS: list[str] = ["HCDS-", "-", "S", "SDCH", "HCDS-HCDS-HCDS-HC"]
+
+
+class RandomBot:
+    def __init__(self, rng: random.Random) -> None:
+        self.random: random.Random = rng
+
+    def get_predictions(self, game_data: dict) -> list[int]:
+        # Predictions in the order they are tried, the server rejects the one the last player may not make.
+        predictions = list(range(game_data["tricks_available"] + 1))
+        self.random.shuffle(predictions)
+        return predictions
+
+    def choose_card(self, cards: list[dict]) -> dict:
+        return self.random.choice(cards)
+
+
+class LowestCardBot(RandomBot):
+    def get_predictions(self, game_data: dict) -> list[int]:
+        return list(range(game_data["tricks_available"] + 1))
+
+    def choose_card(self, cards: list[dict]) -> dict:
+        return min(cards, key=lambda card: VALUES.index(card["value"]))
+
+
+BOTS: dict[str, type[RandomBot]] = {"random": RandomBot, "lowest": LowestCardBot}
+
+
+def get_legal_cards(game_data: dict) -> list[dict]:
+    # Bots only see the game data sent to their connection, like a real client.
+    hand = game_data["private"][game_data["round_number"]]["hand"]
+    if game_data["pile"]:
+        following = [card for card in hand if card["suit"] == game_data["pile"][0]["suit"]]
+        if following:
+            return following
+    return hand
+
+
+class Simulation:
+    def __init__(self, seed: int = 0, bot: str = "random", wire_format: WireFormat = WireFormat.JSON) -> None:
+        self.server: Server = Server(database_path=":memory:")
+        self.random: random.Random = random.Random(seed)
+        self.bot: type[RandomBot] = BOTS[bot]
+        self.wire_format: WireFormat = wire_format
+        self.games_played: int = 0
+        self.moves: int = 0
+        self.bytes_sent: int = 0
+        self.trick_times: list[float] = []
+
+    def play_game(self, number_of_players: int, starting_cards: int, trump_order: str) -> Game:
+        lobby, tokens = create_table(
+            self.server, number_of_players, f"simulation-{self.games_played}", self.wire_format)
+        bots = {player_uuid: self.bot(self.random) for player_uuid in tokens}
+        controller = self.server.controller
+
+        response = controller.request_game_start(
+            tokens[lobby.host], {"starting_cards": starting_cards, "trump_order": trump_order})
+        if response[0] != ResponseState.START_GAME_SUCCESS:
+            raise RuntimeError(f"Could not start game: {response}")
+        game = self.server.game_manager.started[lobby.code]
+
+        # Play until the game ends, timing every card placed so each trick's cost can be reported.
+        trick_time = 0.0
+        while game.waiting_for[1] != GameWaitingState.GAME_END:
+            player_uuid, state = game.waiting_for
+            token = tokens[player_uuid]
+            game_data = self.server.clients[token].game_data
+            if state == GameWaitingState.ROUND_START:
+                response = controller.request_round_start(token)
+            elif state == GameWaitingState.PREDICTION:
+                for prediction in bots[player_uuid].get_predictions(game_data):
+                    response = controller.request_prediction(token, prediction)
+                    if response[0] != ResponseState.INVALID_PREDICTION:
+                        break
+            elif state == GameWaitingState.PLACE_CARD:
+                finishes_trick = len(game.pile) == len(game.players) - 1
+                card = bots[player_uuid].choose_card(get_legal_cards(game_data))
+                start = time.perf_counter()
+                response = controller.request_card_to_place(token, card)
+                trick_time += time.perf_counter() - start
+                if finishes_trick:
+                    self.trick_times.append(trick_time)
+                    trick_time = 0.0
+            else:
+                raise RuntimeError(f"Game {game.code} is waiting for {state}.")
+            if response[0] != ResponseState.SUCCESS:
+                raise RuntimeError(f"Move {state} in game {game.code} failed: {response}")
+            self.moves += 1
+
+        check_game(game)
+        self.retire_game(game, tokens)
+        self.games_played += 1
+        return game
+
+    def retire_game(self, game: Game, tokens: dict[str, str]) -> None:
+        # Finished games are closed so a long run does not keep every table alive or run out of codes.
+        game.close_game()
+        for token in tokens.values():
+            self.bytes_sent += self.server.clients.pop(token).socket.bytes_sent
+
+    def close(self) -> None:
+        self.server.database.close()
+
+
+def check_game(game: Game) -> None:
+    # Every trick is won by exactly one player and total scores add up to the round scores.
+    for round_number in range(game.number_of_rounds):
+        tricks = sum(player["rounds"][round_number]["tricks_won"] for player in game.players.values())
+        assert tricks == game.number_of_rounds - round_number, (game.code, round_number, tricks)
+    for player_uuid, player in game.players.items():
+        assert player["total_score"] == sum(x["score"] for x in player["rounds"].values()), (game.code, player_uuid)
+        assert not game.private_data[player_uuid][game.number_of_rounds - 1]["hand"], (game.code, player_uuid)
+
+
+def get_configurations(players: typing.Iterable[int]) -> list[tuple[int, int, str]]:
+    return [(number_of_players, starting_cards, trump_order)
+            for number_of_players in players
+            for starting_cards in range(52 // number_of_players + 1)
+            for trump_order in TRUMP_ORDERS]
+
+
+def run_throughput(players: list[int], seed: int, bot: str, repeat: int) -> None:
+    for number_of_players in players:
+        simulation = Simulation(seed, bot)
+        configurations = get_configurations([number_of_players]) * repeat
+        start = time.perf_counter()
+        for configuration in configurations:
+            simulation.play_game(*configuration)
+        elapsed = time.perf_counter() - start
+        simulation.close()
+
+        trick_times = sorted(simulation.trick_times)
+        print(f"{number_of_players} players: {simulation.games_played} games, "
+              f"{simulation.games_played / elapsed:.1f} games/s, {simulation.moves / elapsed:.0f} moves/s, "
+              f"trick mean {statistics.fmean(trick_times) * 1e6:.0f} us, "
+              f"p50 {trick_times[len(trick_times) // 2] * 1e6:.0f} us, "
+              f"p99 {trick_times[int(len(trick_times) * 0.99)] * 1e6:.0f} us, "
+              f"{simulation.bytes_sent / simulation.games_played / 1024:.1f} KiB sent per game")
+
+
+def run_allocations(players: list[int], seed: int, bot: str) -> None:
+    # Traced separately because tracemalloc slows everything down and would distort the timings.
+    for number_of_players in players:
+        simulation = Simulation(seed, bot)
+        simulation.play_game(number_of_players, 0, TRUMP_ORDERS[0])
+        gc.collect()
+        tracemalloc.start()
+        blocks_before = sys.getallocatedblocks()
+        game = simulation.play_game(number_of_players, 0, TRUMP_ORDERS[0])
+        _, peak = tracemalloc.get_traced_memory()
+        del game
+        gc.collect()
+        retained_blocks = sys.getallocatedblocks() - blocks_before
+        tracemalloc.stop()
+        simulation.close()
+        print(f"{number_of_players} players: peak {peak / 1024:.0f} KiB traced during one full game, "
+              f"{retained_blocks} blocks retained afterwards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play simulated games against the server without sockets.")
+    parser.add_argument("--players", type=int, nargs="+", default=list(range(2, 8)))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bot", choices=BOTS, default="random")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--skip-allocations", action="store_true")
+    arguments = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    # Dealing uses the module level generator, so it is seeded too for repeatable runs.
+    random.seed(arguments.seed)
+    run_throughput(arguments.players, arguments.seed, arguments.bot, arguments.repeat)
+    if not arguments.skip_allocations:
+        run_allocations(arguments.players, arguments.seed, arguments.bot)
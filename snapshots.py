@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+import time
+import typing
+import zlib
+
+SNAPSHOT_INTERVAL = 5.0
+SNAPSHOT_EXTENSION = ".snapshot"
+MOVE_LOG_EXTENSION = ".log"
+
+
+class GameStore:
+    # Each game has a compressed snapshot and an append-only log of the moves made since that snapshot.
+    def __init__(self, directory: str = "snapshots", snapshot_interval: float = SNAPSHOT_INTERVAL) -> None:
+        self.directory: str = directory
+        self.snapshot_interval: float = snapshot_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # When each game was last snapshotted, games are only written again once they are due.
+        self.snapshot_times: dict[str, float] = {}
+
+        # Operations are (code, kind, data) and are written in order by one writer thread.
+        self.operations: list[tuple[str, str, typing.Any]] = []
+        self.operations_condition: threading.Condition = threading.Condition()
+        self.closing: bool = False
+        self.writer_thread: threading.Thread = threading.Thread(target=self.loop_writes, daemon=True)
+        self.writer_thread.start()
+
+    def get_path(self, game_code: str, extension: str) -> str:
+        return os.path.join(self.directory, game_code + extension)
+
+    def log_move(self, game_code: str, version: int, kind: str, args: tuple) -> None:
+        line = json.dumps([version, kind, args], separators=(",", ":")) + "\n"
+        with self.operations_condition:
+            self.operations.append((game_code, "move", line))
+            self.operations_condition.notify()
+
+    def is_snapshot_due(self, game_code: str) -> bool:
+        last_snapshot = self.snapshot_times.get(game_code)
+        return last_snapshot is None or time.monotonic() - last_snapshot >= self.snapshot_interval
+
+    def save_snapshot(self, game_code: str, snapshot: dict) -> None:
+        # Encoded by the caller so the snapshot matches the game at this moment, compressed on the writer thread.
+        self.snapshot_times[game_code] = time.monotonic()
+        data = json.dumps(snapshot, separators=(",", ":")).encode()
+        with self.operations_condition:
+            self.operations.append((game_code, "snapshot", data))
+            self.operations_condition.notify()
+
+    def remove_game(self, game_code: str) -> None:
+        self.snapshot_times.pop(game_code, None)
+        with self.operations_condition:
+            self.operations.append((game_code, "remove", None))
+            self.operations_condition.notify()
+
+    def loop_writes(self) -> None:
+        while True:
+            with self.operations_condition:
+                self.operations_condition.wait_for(lambda: self.operations or self.closing)
+                operations, self.operations = self.operations, []
+                closing = self.closing
+            self.write(operations)
+            if closing:
+                return
+
+    def write(self, operations: list[tuple[str, str, typing.Any]]) -> None:
+        # Anything queued before a game's last snapshot or removal in this batch is already covered by it.
+        latest: dict[str, int] = {}
+        for i, (game_code, kind, _) in enumerate(operations):
+            if kind != "move":
+                latest[game_code] = i
+        moves: dict[str, list[str]] = {}
+        for i, (game_code, kind, data) in enumerate(operations):
+            if i < latest.get(game_code, -1):
+                continue
+            try:
+                if kind == "snapshot":
+                    self.write_snapshot(game_code, data)
+                elif kind == "remove":
+                    for extension in (SNAPSHOT_EXTENSION, MOVE_LOG_EXTENSION):
+                        if os.path.exists(self.get_path(game_code, extension)):
+                            os.remove(self.get_path(game_code, extension))
+                else:
+                    moves.setdefault(game_code, []).append(data)
+            except OSError as e:
+                logging.error(f"Failed to write {kind} for game {game_code}: {e}")
+        for game_code, lines in moves.items():
+            try:
+                with open(self.get_path(game_code, MOVE_LOG_EXTENSION), "a") as file:
+                    file.writelines(lines)
+            except OSError as e:
+                logging.error(f"Failed to write moves for game {game_code}: {e}")
+
+    def write_snapshot(self, game_code: str, data: bytes) -> None:
+        # The new snapshot replaces the old one in one step, then the moves it already contains are dropped.
+        path = self.get_path(game_code, SNAPSHOT_EXTENSION)
+        with open(path + ".tmp", "wb") as file:
+            file.write(zlib.compress(data))
+        os.replace(path + ".tmp", path)
+        open(self.get_path(game_code, MOVE_LOG_EXTENSION), "w").close()
+
+    def load_games(self) -> list[tuple[str, dict | None, list[list]]]:
+        # Returns every stored game as its code, its snapshot if one was written and the moves logged after it.
+        games = []
+        codes = {os.path.splitext(name)[0] for name in os.listdir(self.directory)
+                 if name.endswith((SNAPSHOT_EXTENSION, MOVE_LOG_EXTENSION))}
+        for game_code in sorted(codes):
+            snapshot = None
+            moves = []
+            try:
+                if os.path.exists(self.get_path(game_code, SNAPSHOT_EXTENSION)):
+                    with open(self.get_path(game_code, SNAPSHOT_EXTENSION), "rb") as file:
+                        snapshot = json.loads(zlib.decompress(file.read()))
+                if os.path.exists(self.get_path(game_code, MOVE_LOG_EXTENSION)):
+                    with open(self.get_path(game_code, MOVE_LOG_EXTENSION)) as file:
+                        for line in file:
+                            # A crash can leave the last line half written, it is the only one that can be lost.
+                            try:
+                                moves.append(json.loads(line))
+                            except json.JSONDecodeError:
+                                break
+            except (OSError, zlib.error, json.JSONDecodeError) as e:
+                logging.error(f"Failed to load game {game_code}: {e}")
+                continue
+            games.append((game_code, snapshot, moves))
+        return games
+
+    def close(self) -> None:
+        with self.operations_condition:
+            self.closing = True
+            self.operations_condition.notify()
+        self.writer_thread.join()
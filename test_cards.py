@@ -0,0 +1,35 @@
+import itertools
+import random
+
+from main import DECK_SIZE, SUITS, get_card_suit, get_card_rank, get_trick_winner
+
+# Trump suits checked, -1 means there are no trumps this round.
+TRUMP_SUITS: list[int] = list(range(-1, len(SUITS)))
+
+
+def get_trick_winner_by_sorting(cards: list[int], trump_suit: int) -> int:
+    # Reference rules: trumps beat everything, then cards of the led suit, then rank decides.
+    def sort_key(i: int):
+        return (get_card_suit(cards[i]) == trump_suit, get_card_suit(cards[i]) == get_card_suit(cards[0]),
+                get_card_rank(cards[i]))
+
+    return max(range(len(cards)), key=sort_key)
+
+
+def test_trick_winner_every_trick() -> None:
+    # Every trick of up to three cards under every trump.
+    for trump_suit in TRUMP_SUITS:
+        for trick_size in range(1, 4):
+            for cards in itertools.permutations(range(DECK_SIZE), trick_size):
+                assert get_trick_winner(cards, trump_suit) == get_trick_winner_by_sorting(cards, trump_suit), \
+                    (cards, trump_suit)
+
+
+def test_trick_winner_random_tricks() -> None:
+    # Random tricks up to the most a table can play.
+    generator = random.Random(0)
+    for _ in range(20000):
+        cards = generator.sample(range(DECK_SIZE), generator.randint(1, 7))
+        trump_suit = generator.choice(TRUMP_SUITS)
+        assert get_trick_winner(cards, trump_suit) == get_trick_winner_by_sorting(cards, trump_suit), \
+            (cards, trump_suit)